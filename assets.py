@@ -4,7 +4,10 @@ import cli
 import sys
 import aws
 import json
+import time
 import string
+import tasks
+from tasks import log
 
 # hierarchy of resource types:
 #
@@ -20,49 +23,58 @@ import string
 type_defs = {
 	'vpc': {
 		'id': 'VpcId',
+		'fields': [ 'VpcId' ],
 		'list': [ 'ec2', 'describe-vpcs', 'Vpcs'],
 		'delete': [ 'ec2', 'delete-vpc', '--vpc-id', '{}' ],
+		# children are deleted in this order
 		'children': [
 			{ 'type': 'load-balancer',     'parent-ref': 'VPCId' },
-			{ 'type': 'route-table',       'filter': [ '--filters', 'Name=vpc-id,Values={}' ] },
-			{ 'type': 'subnet',            'filter': [ '--filters', 'Name=vpc-id,Values={}' ] },
-			{ 'type': 'network-interface', 'filter': [ '--filters', 'Name=vpc-id,Values={},Name=attachment.delete-on-termination,Values=false' ] },
-			{ 'type': 'security-group',    'filter': [ '--filters', 'Name=vpc-id,Values={}' ] },
+			{ 'type': 'network-interface', 'parent-ref': 'VpcId', 'parent-filter': 'vpc-id', 'filter': [ 'Name=attachment.delete-on-termination,Values=false' ] },
+			{ 'type': 'subnet',            'parent-ref': 'VpcId', 'parent-filter': 'vpc-id' },
+			{ 'type': 'route-table',       'parent-ref': 'VpcId', 'parent-filter': 'vpc-id' },
+			{ 'type': 'security-group',    'parent-ref': 'VpcId', 'parent-filter': 'vpc-id' },
 		]
 	},
 	'route-table': {
 		'id': 'RouteTableId',
+		'fields': [ 'RouteTableId', 'VpcId', 'Associations' ],
 		'list': [ 'ec2', 'describe-route-tables', 'RouteTables' ],
 		'delete': [ 'ec2', 'delete-route-table', '--route-table-id', '{}' ],
 	},
 	'network-interface': {
 		'id': 'NetworkInterfaceId',
+		'fields': [ 'NetworkInterfaceId', 'VpcId', 'SubnetId', 'Attachment' ],
 		'list': [ 'ec2', 'describe-network-interfaces', 'NetworkInterfaces' ],
 		'delete': [ 'ec2', 'delete-network-interface', '--network-interface-id', '{}' ],
 	},
 	'load-balancer': {
 		'id': 'LoadBalancerName',
+		'fields': [ 'LoadBalancerName', 'VPCId' ],
 		'list': [ 'elb', 'describe-load-balancers', 'LoadBalancerDescriptions' ],
 		'delete': [ 'elb', 'delete-load-balancer', '--load-balancer-name', '{}' ],
 	},
 	'instance': {
 		'id': 'InstanceId',
+		'fields': [ 'InstanceId', 'VpcId', 'SubnetId' ],
 		'list': [ 'ec2', 'describe-instances', 'Reservations,Instances' ],
 		'delete': [ 'ec2', 'terminate-instances', '--instance-ids', '{}' ],
+		'await': [ 'ec2', 'wait', 'instance-terminated', '--instance-ids', '{}' ],
 #		'children': [
 #			{ 'type': 'network-interface', 'filter': [ '--filters', 'Name=attachment.instance-id,Values={}' ]  },
 #		]
 	},
 	'subnet': {
 		'id': 'SubnetId',
+		'fields': [ 'SubnetId', 'VpcId' ],
 		'list': [ 'ec2', 'describe-subnets', 'Subnets' ],
 		'delete': [ 'ec2', 'delete-subnet', '--subnet-id', '{}' ],
 		'children': [
-			{ 'type': 'instance', 'filter': [ '--filters', 'Name=subnet-id,Values={}' ]  },
+			{ 'type': 'instance', 'parent-ref': 'SubnetId', 'parent-filter': 'subnet-id' },
 		]
 	},
 	'security-group': {
 		'id': 'GroupId',
+		'fields': [ 'GroupId', 'GroupName', 'VpcId' ],
 		'list': [ 'ec2', 'describe-security-groups', 'SecurityGroups' ],
 		'delete': [ 'ec2', 'delete-security-group', '--group-id', '{}' ],
 	},
@@ -91,29 +103,49 @@ def get_items(type_name, item_id=None, filter=[]):
 	if type_def is None:
 		print "Unknown type", type_name
 		sys.exit(1)
-	container = json.loads(aws.aws_cli_verbose(type_def["list"][:-1] + filter))
 	fields = string.split(type_def["list"][-1], ',')
-	items = get_array(type_name, type_def, container, fields)
-	if item_id is not None:
-		items = [item for item in items if item["id"] == item_id]
+	command = type_def["list"][:-1] + filter + [ '--query', aws.projection(fields, type_def["fields"]) ]
+	items = []
+	for page in aws.aws_cli_pages(command):
+		page_items = get_array(type_name, type_def, page, fields)
+		if item_id is not None:
+			page_items = [item for item in page_items if item["id"] == item_id]
+			if len(page_items) > 0:
+				return page_items
+		items += page_items
 	return items
 
+# EC2 accepts at most this many values per filter
+MAX_FILTER_VALUES = 200
+
 def get_tree(type_name, item_id=None, filter=[]):
 	items = get_items(type_name, item_id, filter)
-	for item in items:
-		type_def = type_defs.get(type_name)
-		subtypes = type_def.get("children", [])
-		for subtype in subtypes:
-			subtype_name = subtype["type"]
-			filter = subtype.get("filter", [])
-			filter = [element.replace('{}', item["id"]) for element in filter]
-			children = get_tree(subtype_name, filter=filter)
-			parent_ref = subtype.get("parent-ref", None)
-			if parent_ref is not None:
-				children = [child for child in children if child["item"].get(parent_ref) == item["id"]]
-			item["children"] = item.get("children", []) + children
+	add_children(type_name, items)
 	return items
 
+def add_children(type_name, items):
+	""" Lists each child type once for all items, and joins the children to their parents """
+	if len(items) < 1:
+		return
+	type_def = type_defs.get(type_name)
+	subtypes = type_def.get("children", [])
+	for subtype in subtypes:
+		subtype_name = subtype["type"]
+		children = get_tree(subtype_name, filter=get_children_filter(subtype, items))
+		parent_ref = subtype["parent-ref"]
+		children_by_parent = {}
+		for child in children:
+			children_by_parent.setdefault(child["item"].get(parent_ref), []).append(child)
+		for item in items:
+			item["children"] = item.get("children", []) + children_by_parent.get(item["id"], [])
+
+def get_children_filter(subtype, parents):
+	filters = list(subtype.get("filter", []))
+	parent_filter = subtype.get("parent-filter", None)
+	if parent_filter is not None and len(parents) <= MAX_FILTER_VALUES:
+		filters.append('Name=' + parent_filter + ',Values=' + ','.join([parent["id"] for parent in parents]))
+	return [ '--filters' ] + filters if len(filters) > 0 else []
+
 def print_tree(tree, indent=0):
 	for item in tree:
 		print ' ' * indent + item["type"], item["id"]
@@ -132,6 +164,56 @@ def delete_tree(tree, indent=0):
 			command = [element.replace('{}', item["id"]) for element in command]
 			aws.aws_cli_verbose(command)
 
+DELETE_WORKERS = 8
+
+def delete_tree_waves(tree, workers=DELETE_WORKERS):
+	""" Deletes a tree one depth level at a time, deepest first, deleting each level in parallel
+
+	Items of the same level can depend on each other too (a subnet can't go before the
+	network interfaces in it, or a route table before the subnets associated with it), so
+	each level is deleted one type at a time, in the order the types are listed as
+	children of their parent.
+	"""
+	waves = []
+	level = tree
+	order = []
+	while len(level) > 0:
+		waves[0:0] = split_by_type(level, order)
+		order = [subtype["type"] for item in level for subtype in type_defs[item["type"]].get("children", [])]
+		level = [child for item in level for child in item.get("children", [])]
+	for wave in waves:
+		starttime = time.time()
+		tasks.parallel_map(delete_item, wave, workers)
+		await_deletions(wave)
+		print "deleted", len(wave), "items in", "%.1f" % (time.time() - starttime), "seconds"
+
+def split_by_type(level, order):
+	types = []
+	for type_name in order + [item["type"] for item in level]:
+		if type_name not in types:
+			types.append(type_name)
+	waves = [[item for item in level if item["type"] == type_name] for type_name in types]
+	return [wave for wave in waves if len(wave) > 0]
+
+def delete_item(item):
+	type_def = type_defs[item["type"]]
+	command = type_def.get("delete", None)
+	if command is not None:
+		log("deleting", item["type"], item["id"])
+		command = [element.replace('{}', item["id"]) for element in command]
+		aws.aws_cli_verbose(command)
+
+def await_deletions(wave):
+	""" Waits for asynchronous deletions (like instance termination) to complete, one call per type """
+	for type_name, type_def in type_defs.items():
+		command = type_def.get("await", None)
+		ids = [item["id"] for item in wave if item["type"] == type_name]
+		if command is None or len(ids) < 1:
+			continue
+		print "waiting for", len(ids), type_name + "(s) to be deleted"
+		command = [ids if element == '{}' else [element] for element in command]
+		aws.aws_cli_verbose(sum(command, []), cached=False)
+
 def list_cmd(argv):
 	cli.exit_with_usage(argv) if len(argv) < 2 else None
 	type_name = argv[1]
@@ -150,12 +232,15 @@ def delete_cmd(argv):
 	type_name = argv[1]
 	item_id = argv[2] if argv[2] != "all" else None
 	tree = get_tree(type_name, item_id)
-	delete_tree(tree)
+	if len(argv) > 3 and argv[3] == "--parallel":
+		delete_tree_waves(tree)
+	else:
+		delete_tree(tree)
 
 commands = {
 	"list":    { "func": list_cmd,    "usage": "list <type>" },
 	"tree":    { "func": tree_cmd,    "usage": "tree <type> all|<id>" },
-	"delete":  { "func": delete_cmd,  "usage": "delete <type> all|<id>" },
+	"delete":  { "func": delete_cmd,  "usage": "delete <type> all|<id> [--parallel]" },
 }
 
 if __name__ == '__main__':
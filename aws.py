@@ -7,6 +7,14 @@ import errno
 import urllib
 import zipfile
 import subprocess
+import threading
+import glob
+import time
+import atexit
+import collections
+import json
+import config
+from StringIO import StringIO
 
 HOME_DIR = os.path.expanduser("~")
 AWS_CLI_DIR = HOME_DIR + "/.aws-cli"
@@ -15,24 +23,92 @@ AWS_CLI_ZIP = AWS_CLI_DIR + "/aws.zip"
 AWS_CLI_URL = "https://s3.amazonaws.com/aws-cli/awscli-bundle.zip"
 AWS_CLI_INSTALL = AWS_CLI_DIR + "/awscli-bundle/install"
 
-def aws_cli(argv):
-	install_aws_cli_if_required()
+BACKEND = None
+REGION = None
+CACHE = None
+PAGE_SIZE = 100
+# Services whose paginated operations have no page size parameter, so the CLI has no --page-size for them
+UNSIZED_SERVICES = [ 'cloudformation' ]
+
+def aws_cli(argv, cached=True):
+	backend = get_backend()
 	verify_region(argv)
 	command = [
-		AWS_CLI_BIN,
 		'--no-paginate',
 		'--output', 'json'
 	]
-	return subprocess.check_output(command + argv, stderr=subprocess.STDOUT)
+	call = lambda: backend.call(command + endpoint_options() + argv)
+	return get_cache().call(argv, REGION, call, cached)
 
-def aws_cli_verbose(argv):
+def aws_cli_verbose(argv, cached=True):
 	try:
-		return aws_cli(argv)
+		return aws_cli(argv, cached)
 	except subprocess.CalledProcessError as error:
-		print ' '.join(argv)
-		print 'Command failed with exit code', error.returncode
-		print error.output
-		sys.exit(error.returncode)
+		exit_with_error(argv, error)
+
+def aws_cli_pages(argv, page_size=PAGE_SIZE, cached=True):
+	""" Yields the parsed output of a paginated command one page at a time
+
+	Only one page is requested (and held in memory) at a time, so callers that stop
+	iterating early don't pay for the rest of the results. The service is asked for pages
+	of the same size, otherwise each call would fetch from the start of the service page
+	the token points into and throw away what was already seen.
+	"""
+	backend = get_backend()
+	verify_region(argv)
+	command = [
+		'--output', 'json'
+	]
+	sizing = [ '--max-items', str(page_size) ]
+	if argv[0] not in UNSIZED_SERVICES:
+		sizing += [ '--page-size', str(page_size) ]
+	paging = sizing
+	while True:
+		call = lambda: backend.call(command + endpoint_options() + argv + paging)
+		try:
+			page = json.loads(get_cache().call(argv + paging, REGION, call, cached))
+		except subprocess.CalledProcessError as error:
+			exit_with_error(argv, error)
+		yield page
+		token = page.get("NextToken")
+		if token is None:
+			return
+		paging = sizing + [ '--starting-token', token ]
+
+def aws_cli_items(argv, path, fields=None, page_size=PAGE_SIZE, cached=True):
+	""" Yields the items of a paginated command, found under a comma-separated path of keys
+
+	If fields are given, items only carry those (top-level) fields. The projection is
+	applied by the AWS CLI, so much less JSON needs to be produced and parsed. Fields an
+	item does not have are still there, with a null value.
+	"""
+	keys = path.split(',')
+	if fields is not None:
+		argv = argv + [ '--query', projection(keys, fields) ]
+	for page in aws_cli_pages(argv, page_size, cached):
+		for item in nested_items(page, keys):
+			yield item
+
+def projection(keys, fields):
+	""" Returns a JMESPath query that keeps only the given fields of the items under keys """
+	expression = '{' + ', '.join([ field + ': ' + field for field in fields ]) + '}'
+	for key in reversed(keys[1:]):
+		expression = '{' + key + ': ' + key + '[].' + expression + '}'
+	return '{' + keys[0] + ': ' + keys[0] + '[].' + expression + ', NextToken: NextToken}'
+
+def nested_items(container, keys):
+	for item in container.get(keys[0]) or []:
+		if len(keys) == 1:
+			yield item
+		else:
+			for nested_item in nested_items(item, keys[1:]):
+				yield nested_item
+
+def exit_with_error(argv, error):
+	print ' '.join(argv)
+	print 'Command failed with exit code', error.returncode
+	print error.output
+	sys.exit(error.returncode)
 
 def install_aws_cli_if_required():
 	if os.path.isfile(AWS_CLI_BIN) and os.access(AWS_CLI_BIN, os.X_OK):
@@ -50,17 +126,285 @@ def install_aws_cli_if_required():
 	print "   Version:", version
 	print "   Done"
 
+""" Backends that execute AWS CLI commands and return their output """
+
+class SubprocessBackend(object):
+	""" Runs every command in a freshly forked copy of the private AWS CLI """
+
+	def call(self, argv):
+		install_aws_cli_if_required()
+		return subprocess.check_output([ AWS_CLI_BIN ] + argv, stderr=subprocess.STDOUT)
+
+class InProcessBackend(object):
+	""" Runs commands through the AWS CLI driver inside this interpreter
+
+	Drivers are kept in a pool for the life of the process, and each call checks one
+	out, so a driver is only used by one thread at a time while short-lived worker
+	threads still reuse the service clients (and with them their keep-alive connection
+	pools) of earlier calls. Output is captured per thread so that results look exactly
+	like they would coming from the subprocess backend.
+	"""
+
+	def __init__(self, create_clidriver):
+		self.create_clidriver = create_clidriver
+		self.drivers = []
+		self.lock = threading.Lock()
+		self.output = capture_stream('stdout')
+		self.errors = capture_stream('stderr')
+
+	def checkout(self):
+		with self.lock:
+			if len(self.drivers) > 0:
+				return self.drivers.pop()
+		driver = self.create_clidriver()
+		reuse_clients(driver.session)
+		return driver
+
+	def checkin(self, driver):
+		with self.lock:
+			self.drivers.append(driver)
+
+	def call(self, argv):
+		driver = self.checkout()
+		# The CLI saves --region on the session, where it must not outlive this call. A --profile
+		# also loads credentials into the session, so such calls get a driver of their own
+		saved = session_variables(driver.session)
+		if has_option(argv, '--profile') or (saved is None and has_option(argv, '--region')):
+			self.checkin(driver)
+			driver = self.create_clidriver()
+			saved = None
+			pooled = False
+		else:
+			pooled = True
+		buffer = StringIO()
+		self.output.capture(buffer)
+		self.errors.capture(buffer)
+		try:
+			returncode = driver.main(list(argv))
+		finally:
+			self.output.release()
+			self.errors.release()
+			if saved is not None:
+				restore_session_variables(driver.session, saved)
+			if pooled:
+				self.checkin(driver)
+		output = buffer.getvalue()
+		if returncode != 0:
+			raise subprocess.CalledProcessError(returncode, [ 'aws' ] + argv, output)
+		return output
+
+class CapturingStream(object):
+	""" Stand-in for sys.stdout/sys.stderr that diverts writes of capturing threads """
+
+	def __init__(self, stream):
+		self.stream = stream
+		self.local = threading.local()
+
+	def capture(self, buffer):
+		self.local.buffer = buffer
+
+	def release(self):
+		self.local.buffer = None
+
+	def target(self):
+		buffer = getattr(self.local, 'buffer', None)
+		return buffer if buffer is not None else self.stream
+
+	def write(self, data):
+		self.target().write(data)
+
+	def writelines(self, lines):
+		self.target().writelines(lines)
+
+	def flush(self):
+		self.target().flush()
+
+	def __getattr__(self, name):
+		return getattr(self.stream, name)
+
+def capture_stream(name):
+	stream = getattr(sys, name)
+	if not isinstance(stream, CapturingStream):
+		stream = CapturingStream(stream)
+		setattr(sys, name, stream)
+	return stream
+
+def has_option(argv, option):
+	return any(arg == option or arg.startswith(option + '=') for arg in argv)
+
+def session_variables(session):
+	""" Returns a copy of the configuration variables set on a session, or None if it doesn't have them """
+	variables = getattr(session, '_session_instance_vars', None)
+	return dict(variables) if isinstance(variables, dict) else None
+
+def restore_session_variables(session, saved):
+	variables = session._session_instance_vars
+	variables.clear()
+	variables.update(saved)
+
+def reuse_clients(session):
+	clients = {}
+	create_client = session.create_client
+	lock = threading.Lock()
+	def create_or_reuse_client(*args, **kwargs):
+		key = (args, tuple(sorted(kwargs.items())))
+		try:
+			hash(key)
+		except TypeError:
+			return create_client(*args, **kwargs)
+		with lock:
+			client = clients.get(key)
+			if client is None:
+				client = clients[key] = create_client(*args, **kwargs)
+		return client
+	session.create_client = create_or_reuse_client
+
+def load_clidriver():
+	install_aws_cli_if_required()
+	version = 'python%d.%d' % sys.version_info[:2]
+	for site_packages in glob.glob(AWS_CLI_DIR + '/lib/' + version + '/site-packages'):
+		if site_packages not in sys.path:
+			sys.path.append(site_packages)
+	try:
+		from awscli.clidriver import create_clidriver
+		return create_clidriver
+	except ImportError:
+		return None
+
+def get_backend():
+	global BACKEND
+	if BACKEND is None:
+		backend = config.get('aws', 'backend', default=None)
+		create_clidriver = load_clidriver() if backend != 'subprocess' else None
+		if create_clidriver is not None:
+			BACKEND = InProcessBackend(create_clidriver)
+		else:
+			BACKEND = SubprocessBackend()
+	return BACKEND
+
+def endpoint_options():
+	""" Lets all AWS calls be pointed at a stub endpoint, e.g. for testing """
+	endpoint_url = config.get('aws', 'endpoint-url', default=None)
+	return [ '--endpoint-url', endpoint_url ] if endpoint_url is not None else []
+
+""" Response cache for read-only commands """
+
+# Mutating commands of a service also invalidate cached results of these services
+INVALIDATES = {
+	'elb':            [ 'elb', 'ec2' ],
+	'rds':            [ 'rds', 'ec2' ],
+	's3':             [ 's3', 's3api' ],
+	's3api':          [ 's3', 's3api' ],
+	'cloudformation': None,
+}
+
+class ResponseCache(object):
+	""" Memoizes read-only commands by argv and region, with a ttl and bounded size """
+
+	def __init__(self, ttl, size):
+		self.ttl = ttl
+		self.size = size
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.invalidations = 0
+
+	def call(self, argv, region, call, cached=True):
+		service, operation = command_name(argv)
+		if is_read_only(service, operation):
+			if not cached or self.ttl <= 0:
+				return call()
+			key = (tuple(argv), region)
+			output = self.get(key)
+			if output is None:
+				output = call()
+				self.put(key, service, output)
+			return output
+		if not is_mutating(service, operation):
+			return call()
+		try:
+			return call()
+		finally:
+			self.invalidate(service)
+
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None or entry[0] < time.time():
+				self.misses += 1
+				return None
+			self.entries[key] = entry
+			self.hits += 1
+			return entry[2]
+
+	def put(self, key, service, output):
+		with self.lock:
+			self.entries[key] = (time.time() + self.ttl, service, output)
+			while len(self.entries) > self.size:
+				self.entries.popitem(last=False)
+
+	def invalidate(self, service):
+		services = INVALIDATES.get(service, [ service ])
+		with self.lock:
+			for key, entry in self.entries.items():
+				if services is None or entry[1] in services:
+					del self.entries[key]
+					self.invalidations += 1
+
+	def stats(self):
+		return { "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations }
+
+def command_name(argv):
+	""" Returns (service, operation), skipping any options that precede the operation """
+	service = argv[0] if len(argv) > 0 else None
+	i = 1
+	while i < len(argv) and argv[i].startswith('--'):
+		i += 2 if i + 1 < len(argv) and not argv[i + 1].startswith('--') else 1
+	operation = argv[i] if i < len(argv) else None
+	return service, operation
+
+def is_read_only(service, operation):
+	if service == 'configure' or operation is None:
+		return False
+	if service == 's3':
+		return operation == 'ls'
+	return operation.startswith(('describe-', 'list-', 'get-'))
+
+def is_mutating(service, operation):
+	if service == 'configure' or operation in [ None, 'wait' ]:
+		return False
+	return not is_read_only(service, operation)
+
+def get_cache():
+	global CACHE
+	if CACHE is None:
+		ttl = float(config.get('aws', 'cache-ttl', default=None) or 30)
+		size = int(config.get('aws', 'cache-size', default=None) or 256)
+		CACHE = ResponseCache(ttl, size)
+		if config.get('aws', 'cache-stats', default=None) == 'true':
+			atexit.register(print_cache_stats)
+	return CACHE
+
+def print_cache_stats():
+	sys.stderr.write("aws cache: %(hits)d hits, %(misses)d misses, %(invalidations)d invalidations\n" % CACHE.stats())
+
 def get_s3_endpoint(region):
 	if region == 'us-east-1':
 		return 'http://s3.amazonaws.com'
 	return 'http://s3-' + region + '.amazonaws.com'
 
 def verify_region(argv):
+	global REGION
+	if REGION is not None:
+		return
 	command = [
-		AWS_CLI_BIN,
 		'configure', 'get', 'region'
 	]
-	region = subprocess.check_output(command, stderr=subprocess.STDOUT)
+	try:
+		region = get_backend().call(command)
+	except subprocess.CalledProcessError:
+		region = ''
 	segments = region.strip().split('-')
 	if len(region) < 1:
 		print "aws region must be specified"
@@ -70,6 +414,7 @@ def verify_region(argv):
 		if len(segments) > 2 and len(segments[2]) > 1:
 			print "and the last part must specify a region number but no availability zone letter"
 	else:
+		REGION = region.strip()
 		return
 	print 'use "aws configure set region <region>" to fix your region before proceeding'
 	sys.exit(1)
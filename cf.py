@@ -122,12 +122,12 @@ def find_load_balancer(stack, dns_name):
 		'elb',
 		'describe-load-balancers'
 	]
-	load_balancers = json.loads(aws.aws_cli_verbose(command))["LoadBalancerDescriptions"]
-	load_balancers = [ lb for lb in load_balancers if lb["DNSName"] == dns_name]
-	if len(load_balancers) != 1:
+	load_balancers = aws.aws_cli_items(command, 'LoadBalancerDescriptions', [ 'LoadBalancerName', 'DNSName' ])
+	load_balancer = next((lb for lb in load_balancers if lb["DNSName"] == dns_name), None)
+	if load_balancer is None:
 		print "Could not resolve load balancer for dns name", dns_name
 		sys.exit(1)
-	return load_balancers[0]
+	return load_balancer
 
 def get_server_certificate(stack):
 	certificate_arn  = config.get("aws", "ssl-certificate-arn", stack=stack["StackName"])
@@ -3,8 +3,25 @@
 import cli
 import aws as aws_module
 import sys
+import re
 import json
 import config
+import tasks
+import time
+import threading
+import subprocess
+from functools import partial
+from tasks import log
+
+# Errors that mean a resource still has dependencies that are being removed concurrently
+RETRYABLE_ERRORS = [
+	'DependencyViolation',
+	'InvalidNetworkInterface.InUse',
+	'InvalidDBInstanceState',
+	'InvalidDBSubnetGroupStateFault',
+	'ResourceInUse',
+	'BucketNotEmpty',
+]
 
 def aws(argv):
 	try:
@@ -12,206 +29,336 @@ def aws(argv):
 	except ValueError:
 		return None
 
+def aws_delete(argv):
+	""" Runs a command that removes a resource, from within a task graph """
+	try:
+		output = aws_module.aws_cli(argv)
+	except subprocess.CalledProcessError as error:
+		code = error_code(error)
+		if code in RETRYABLE_ERRORS:
+			raise tasks.RetryLater(code)
+		if code is not None and 'NotFound' in code:
+			return None
+		raise Exception(' '.join(argv) + ': ' + error.output.strip())
+	try:
+		return json.loads(output)
+	except ValueError:
+		return None
+
+def error_code(error):
+	match = re.search(r'\(([\w.]+)\) when calling', error.output)
+	return match.group(1) if match is not None else None
+
+def get_workers():
+	return int(config.get('cleanup', 'workers', default=None) or 8)
+
+def get_bucket_workers():
+	return int(config.get('cleanup', 'bucket-workers', default=None) or 4)
+
+def run_tasks(graph):
+	failed = graph.run()
+	if len(failed) > 0:
+		print len(failed), "resources could not be removed"
+		sys.exit(1)
+
 def remove_network_interface(interface):
-	print "remove network interface", interface
+	log("remove network interface", interface)
 	command = [
 		'ec2',
 		'delete-network-interface',
 		'--network-interface-id', interface
 	]
-	aws(command)
-
-def remove_vpc_network_interfaces(vpc):
-	command = [
-		'ec2',
-		'describe-network-interfaces',
-		'--filters', 'Name=vpc-id,Values=' + vpc
-	]
-	interfaces = aws(command)["NetworkInterfaces"]
-	for interface in interfaces:
-		remove_network_interface(interface["NetworkInterfaceId"])
+	aws_delete(command)
 
 def remove_load_balancer(load_balancer):
-	print "remove load-balancer", load_balancer
+	log("remove load-balancer", load_balancer)
 	command = [
 		'elb',
 		'delete-load-balancer',
 		'--load-balancer-name', load_balancer
 	]
-	aws(command)
+	aws_delete(command)
 
-def remove_vpc_load_balancers(vpc):
-	command = [
-		'elb',
-		'describe-load-balancers',
-	]
-	load_balancers = aws(command)["LoadBalancerDescriptions"]
-	load_balancers = [elb for elb in load_balancers if elb["VPCId"] == vpc]
-	for load_balancer in load_balancers:
-		remove_load_balancer(load_balancer["LoadBalancerName"])
-
-def remove_instance(instance):
-	print "remove instance", instance
+def remove_instance(instance, terminated_instances):
+	""" Starts terminating an instance, and returns a check for when it is gone """
+	log("remove instance", instance)
 	command = [
 		'ec2',
 		'terminate-instances',
 		'--instance-ids', instance
 	]
-	aws(command)
+	aws_delete(command)
+	return partial(terminated_instances.is_terminated, instance)
 
-def remove_vpc_instances(vpc):
-	command = [
-		'ec2',
-		'describe-instances',
-		'--filters', 'Name=vpc-id,Values=' + vpc
-	]
-	reservations = aws(command)["Reservations"]
-	for reservation in reservations:
-		instances = reservation["Instances"]
-		for instance in instances:
-			remove_instance(instance["InstanceId"])
+class TerminatedInstances(object):
+	""" Tells whether instances are terminated, listing all live instances at most once per interval """
+
+	def __init__(self, interval=5):
+		self.interval = interval
+		self.listed = 0
+		self.existing = set()
+		self.lock = threading.Lock()
+
+	def is_terminated(self, instance):
+		with self.lock:
+			if time.time() - self.listed >= self.interval:
+				command = [
+					'ec2',
+					'describe-instances',
+					'--filters', 'Name=instance-state-name,Values=pending,running,shutting-down,stopping,stopped'
+				]
+				instances = aws_module.aws_cli_items(command, 'Reservations,Instances', [ 'InstanceId' ], cached=False)
+				self.existing = set(i["InstanceId"] for i in instances)
+				self.listed = time.time()
+			return instance not in self.existing
 
 def remove_subnet(subnet):
-	print "remove subnet", subnet
+	log("remove subnet", subnet)
 	command = [
 		'ec2',
 		'delete-subnet',
 		'--subnet-id', subnet
 	]
-	aws(command)
-
-def remove_vpc_subnets(vpc):
-	command = [
-		'ec2',
-		'describe-subnets',
-		'--filters', 'Name=vpc-id,Values=' + vpc
-	]
-	subnets = aws(command)["Subnets"]
-	for subnet in subnets:
-		remove_subnet(subnet["SubnetId"])
+	aws_delete(command)
 
 def remove_security_group(group):
-	print "remove security-group", group
+	log("remove security-group", group)
 	command = [
 		'ec2',
 		'delete-security-group',
 		'--group-id', group
 	]
-	aws(command)
-
-def remove_vpc_security_groups(vpc):
-	command = [
-		'ec2',
-		'describe-security-groups',
-		'--filters', 'Name=vpc-id,Values=' + vpc
-	]
-	groups = aws(command)["SecurityGroups"]
-	groups = [ group for group in groups if group["GroupName"] != "default" ]
-	for group in groups:
-		remove_security_group(group["GroupId"])
+	aws_delete(command)
 
 def remove_route_table(table):
-	print "remove route-table", table
+	log("remove route-table", table)
 	command = [
 		'ec2',
 		'delete-route-table',
 		'--route-table-id', table
 	]
-	aws(command)
-
-def remove_vpc_route_tables(vpc):
-	command = [
-		'ec2',
-		'describe-route-tables',
-		'--filters', 'Name=vpc-id,Values=' + vpc
-	]
-	tables = aws(command)["RouteTables"]
-	tables = [ table for table in tables if len(table["Associations"]) == 0 ]
-	for table in tables:
-		remove_route_table(table["RouteTableId"])
+	aws_delete(command)
 
 def detach_internet_gateway(gateway, vpc):
-	print "detach internet-gateway", gateway
+	log("detach internet-gateway", gateway)
 	command = [
 		'ec2',
 		'detach-internet-gateway',
 		'--internet-gateway-id', gateway,
 		'--vpc-id', vpc
 	]
-	aws(command)
+	aws_delete(command)
 
-def detach_vpc_internet_gateways(vpc):
-	command = [
-		'ec2',
-		'describe-internet-gateways',
-		'--filters', 'Name=attachment.vpc-id,Values=' + vpc
-	]
-	gateways = aws(command)["InternetGateways"]
-	for gateway in gateways:
-		detach_internet_gateway(gateway["InternetGatewayId"], vpc)
-
-def remove_rds_instance(instance):
-	print "remove rds-instance", instance
+def remove_rds_instance(instance, deleted_instances):
+	""" Starts deleting an rds instance, and returns a check for when it is gone """
+	log("remove rds-instance", instance)
 	command = [
 		'rds',
 		'delete-db-instance',
 		'--db-instance-identifier', instance,
 		'--skip-final-snapshot'
 	]
-	aws(command)
-	command = [
-		'rds',
-		'wait',
-		'db-instance-deleted',
-		'--db-instance-identifier', instance
-	]
-	aws(command)
+	try:
+		aws_delete(command)
+	except tasks.RetryLater:
+		# An instance that is already being deleted (by an earlier run) can't be deleted again
+		if not deleted_instances.is_deleting(instance):
+			raise
+	return partial(deleted_instances.is_deleted, instance)
+
+class DeletedDbInstances(object):
+	""" Tells whether rds instances are gone, listing all instances at most once per interval """
+
+	def __init__(self, interval=5):
+		self.interval = interval
+		self.listed = 0
+		self.statuses = {}
+		self.lock = threading.Lock()
+
+	def get_status(self, instance):
+		with self.lock:
+			if time.time() - self.listed >= self.interval:
+				command = [
+					'rds',
+					'describe-db-instances'
+				]
+				instances = json.loads(aws_module.aws_cli_verbose(command, cached=False))["DBInstances"]
+				self.statuses = dict((db["DBInstanceIdentifier"], db["DBInstanceStatus"]) for db in instances)
+				self.listed = time.time()
+			return self.statuses.get(instance)
+
+	def is_deleted(self, instance):
+		return self.get_status(instance) is None
+
+	def is_deleting(self, instance):
+		return self.get_status(instance) in [ None, 'deleting' ]
 
 def remove_rds_subnet_group(group):
-	print "remove rds-subnet-group", group
+	log("remove rds-subnet-group", group)
 	command = [
 		'rds',
 		'delete-db-subnet-group',
 		'--db-subnet-group-name', group
 	]
-	aws(command)
+	aws_delete(command)
 
-def remove_vpc_rds_instances(vpc):
+def remove_vpc_only(vpc):
+	log("remove vpc", vpc)
 	command = [
-		'rds',
-		'describe-db-instances',
+		'ec2',
+		'delete-vpc',
+		'--vpc-id', vpc
 	]
-	instances = aws(command)["DBInstances"]
-	instances = [db for db in instances if db["DBSubnetGroup"]["VpcId"] == vpc]
-	for instance in instances:
-		remove_rds_instance(instance["DBInstanceIdentifier"])
-		remove_rds_subnet_group(instance["DBSubnetGroup"]["DBSubnetGroupName"])
+	aws_delete(command)
 
-def remove_vpc(vpc):
+def vpc_inventory(vpcs):
+	""" Collect the dependent resources of all given vpcs in one pass, indexed by vpc id """
+	inventory = dict((vpc, {
+		"LoadBalancerDescriptions": [],
+		"Instances": [],
+		"DBInstances": [],
+		"NetworkInterfaces": [],
+		"Subnets": [],
+		"SecurityGroups": [],
+		"RouteTables": [],
+		"InternetGateways": [],
+	}) for vpc in vpcs)
+	if len(vpcs) < 1:
+		return inventory
+	vpc_filter = 'Name=vpc-id,Values=' + ','.join(vpcs)
+	def index(key, items, vpc_of):
+		for item in items:
+			resources = inventory.get(vpc_of(item))
+			if resources is not None:
+				resources[key].append(item)
+	command = [
+		'elb',
+		'describe-load-balancers'
+	]
+	index("LoadBalancerDescriptions", aws(command)["LoadBalancerDescriptions"], lambda elb: elb.get("VPCId"))
 	command = [
 		'ec2',
-		'describe-vpcs',
-		'--filters', 'Name=vpc-id,Values=' + vpc
+		'describe-instances',
+		'--filters', vpc_filter, 'Name=instance-state-name,Values=pending,running,shutting-down,stopping,stopped'
 	]
-	vpcs = aws(command)["Vpcs"]
+	instances = aws_module.aws_cli_items(command, 'Reservations,Instances', [ 'InstanceId', 'VpcId', 'SubnetId' ])
+	index("Instances", instances, lambda instance: instance.get("VpcId"))
+	command = [
+		'rds',
+		'describe-db-instances'
+	]
+	index("DBInstances", aws(command)["DBInstances"], lambda db: db["DBSubnetGroup"]["VpcId"])
+	command = [
+		'ec2',
+		'describe-network-interfaces',
+		'--filters', vpc_filter
+	]
+	interfaces = aws_module.aws_cli_items(command, 'NetworkInterfaces', [ 'NetworkInterfaceId', 'VpcId', 'SubnetId', 'RequesterManaged', 'Attachment' ])
+	# Interfaces owned by AWS services or deleted along with their instance go away with their owner
+	interfaces = ( eni for eni in interfaces if not eni.get("RequesterManaged", False) )
+	interfaces = ( eni for eni in interfaces if not (eni.get("Attachment") or {}).get("DeleteOnTermination", False) )
+	index("NetworkInterfaces", interfaces, lambda eni: eni["VpcId"])
+	command = [
+		'ec2',
+		'describe-subnets',
+		'--filters', vpc_filter
+	]
+	index("Subnets", aws(command)["Subnets"], lambda subnet: subnet["VpcId"])
+	command = [
+		'ec2',
+		'describe-security-groups',
+		'--filters', vpc_filter
+	]
+	index("SecurityGroups", aws(command)["SecurityGroups"], lambda group: group["VpcId"])
+	command = [
+		'ec2',
+		'describe-route-tables',
+		'--filters', vpc_filter
+	]
+	index("RouteTables", aws(command)["RouteTables"], lambda table: table["VpcId"])
+	command = [
+		'ec2',
+		'describe-internet-gateways',
+		'--filters', 'Name=attachment.vpc-id,Values=' + ','.join(vpcs)
+	]
+	for gateway in aws(command)["InternetGateways"]:
+		for attachment in gateway.get("Attachments", []):
+			resources = inventory.get(attachment["VpcId"])
+			if resources is not None:
+				resources["InternetGateways"].append(gateway)
+	return inventory
+
+def add_rds_tasks(graph, inventory, deleted_instances):
+	""" Adds removal of rds instances and their subnet groups, and returns the group task of each instance """
+	group_members = {}
+	for db in inventory["DBInstances"]:
+		db_id = db["DBInstanceIdentifier"]
+		group = db["DBSubnetGroup"]["DBSubnetGroupName"]
+		group_members.setdefault(group, []).append(graph.add('rds-instance:' + db_id, partial(remove_rds_instance, db_id, deleted_instances)))
+	databases = {}
+	for db in inventory["DBInstances"]:
+		group = db["DBSubnetGroup"]["DBSubnetGroupName"]
+		databases[db["DBInstanceIdentifier"]] = graph.add('rds-subnet-group:' + group, partial(remove_rds_subnet_group, group), group_members[group])
+	return databases
+
+def add_vpc_tasks(graph, vpc, inventory, databases, terminated_instances):
+	""" Adds removal of a vpc and its dependencies to the graph, and returns the vpc task """
+	load_balancers = {}
+	for elb in inventory["LoadBalancerDescriptions"]:
+		name = elb["LoadBalancerName"]
+		load_balancers[name] = graph.add('load-balancer:' + name, partial(remove_load_balancer, name))
+	instances = {}
+	for instance in inventory["Instances"]:
+		instance_id = instance["InstanceId"]
+		instances[instance_id] = graph.add('instance:' + instance_id, partial(remove_instance, instance_id, terminated_instances))
+	interfaces = {}
+	for eni in inventory["NetworkInterfaces"]:
+		eni_id = eni["NetworkInterfaceId"]
+		interfaces[eni_id] = graph.add('network-interface:' + eni_id, partial(remove_network_interface, eni_id), load_balancers.values() + instances.values())
+	subnets = []
+	for subnet in inventory["Subnets"]:
+		subnet_id = subnet["SubnetId"]
+		depends  = [ load_balancers[elb["LoadBalancerName"]] for elb in inventory["LoadBalancerDescriptions"] if subnet_id in elb.get("Subnets", []) ]
+		depends += [ instances[i["InstanceId"]] for i in inventory["Instances"] if i.get("SubnetId") == subnet_id ]
+		depends += [ interfaces[eni["NetworkInterfaceId"]] for eni in inventory["NetworkInterfaces"] if eni.get("SubnetId") == subnet_id ]
+		depends += [ databases[db["DBInstanceIdentifier"]] for db in inventory["DBInstances"]
+			if subnet_id in [ s["SubnetIdentifier"] for s in db["DBSubnetGroup"].get("Subnets", []) ] ]
+		subnets.append(graph.add('subnet:' + subnet_id, partial(remove_subnet, subnet_id), depends))
+	members = load_balancers.values() + instances.values() + databases.values() + interfaces.values()
+	groups = [ group for group in inventory["SecurityGroups"] if group["GroupName"] != "default" ]
+	groups = [ graph.add('security-group:' + group["GroupId"], partial(remove_security_group, group["GroupId"]), members) for group in groups ]
+	tables = [ table for table in inventory["RouteTables"] if not any(a.get("Main", False) for a in table["Associations"]) ]
+	tables = [ graph.add('route-table:' + table["RouteTableId"], partial(remove_route_table, table["RouteTableId"]), subnets) for table in tables ]
+	gateways = [ gateway["InternetGatewayId"] for gateway in inventory["InternetGateways"] ]
+	gateways = [ graph.add('internet-gateway:' + gateway, partial(detach_internet_gateway, gateway, vpc), members) for gateway in gateways ]
+	depends = members + subnets + groups + tables + gateways
+	return graph.add('vpc:' + vpc, partial(remove_vpc_only, vpc), depends)
+
+def add_vpcs_tasks(graph, vpcs):
 	if len(vpcs) < 1:
-		return
-	print "remove dependencies of vpc", vpc
-	remove_vpc_load_balancers(vpc)
-	remove_vpc_instances(vpc)
-	remove_vpc_rds_instances(vpc)
-	remove_vpc_network_interfaces(vpc)
-	remove_vpc_subnets(vpc)
-	remove_vpc_security_groups(vpc)
-	remove_vpc_route_tables(vpc)
-	detach_vpc_internet_gateways(vpc)
-	print "remove vpc", vpc
+		return []
 	command = [
 		'ec2',
-		'delete-vpc',
-		'--vpc-id', vpc
+		'describe-vpcs',
+		'--filters', 'Name=vpc-id,Values=' + ','.join(vpcs)
 	]
-	aws(command)
+	vpcs = [ vpc["VpcId"] for vpc in aws(command)["Vpcs"] ]
+	inventory = vpc_inventory(vpcs)
+	# Start deleting rds instances of all vpcs first, since that takes longest
+	deleted_instances = DeletedDbInstances()
+	databases = {}
+	for vpc in vpcs:
+		databases[vpc] = add_rds_tasks(graph, inventory[vpc], deleted_instances)
+	terminated_instances = TerminatedInstances()
+	return [ add_vpc_tasks(graph, vpc, inventory[vpc], databases[vpc], terminated_instances) for vpc in vpcs ]
+
+def remove_vpc(vpc):
+	remove_vpcs([ vpc ])
+
+def remove_vpcs(vpcs):
+	graph = tasks.TaskGraph(workers=get_workers())
+	add_vpcs_tasks(graph, vpcs)
+	run_tasks(graph)
 
 def remove_all_vpcs():
 	command = [
@@ -219,42 +366,90 @@ def remove_all_vpcs():
 		'describe-vpcs'
 	]
 	vpcs = aws(command)["Vpcs"]
-	for vpc in vpcs:
-		if not vpc["IsDefault"]:
-			remove_vpc(vpc["VpcId"])
+	remove_vpcs([ vpc["VpcId"] for vpc in vpcs if not vpc["IsDefault"] ])
 
-def remove_bucket(bucket):
+def bucket_exists(bucket):
+	command = [
+		's3api', 'head-bucket',
+		'--bucket', bucket
+	]
 	try:
-		command = [
-			's3', 'ls',
-			's3://' + bucket
-		]
-		aws_module.aws_cli(command)
-	except:
+		aws_module.aws_cli(command, cached=False)
+	except subprocess.CalledProcessError as error:
+		if error_code(error) in [ '404', 'NotFound', 'NoSuchBucket' ]:
+			return False
+		raise Exception(' '.join(command) + ': ' + error.output.strip())
+	return True
+
+def remove_bucket(bucket):
+	if not bucket_exists(bucket):
 		return
-	print "remove bucket", bucket
+	log("remove bucket", bucket)
+	drain_bucket(bucket)
 	command = [
-		's3', 'rm', '--recursive',
-		's3://' + bucket
+		's3api', 'delete-bucket',
+		'--bucket', bucket
 	]
-	aws(command)
+	aws_delete(command)
+
+def drain_bucket(bucket):
+	""" Deletes all objects of a bucket, including old versions and delete markers """
+	starttime = time.time()
+	pool = tasks.WorkerPool(get_bucket_workers(), backlog=get_bucket_workers())
+	deleted = { "count": 0, "lock": threading.Lock() }
+	for batch in list_bucket_versions(bucket):
+		pool.submit(delete_bucket_objects, bucket, batch, deleted)
+	errors = pool.join()
+	if len(errors) > 0:
+		raise errors[0]
+	seconds = max(time.time() - starttime, 0.001)
+	log("drained bucket", bucket + ":", deleted["count"], "objects in", "%.1f" % seconds, "seconds", "(%d objects/sec)" % (deleted["count"] / seconds))
+
+def list_bucket_versions(bucket):
+	""" Yields the keys and version ids of all objects in a bucket, one page of up to 1000 at a time """
+	markers = []
+	while True:
+		command = [
+			's3api', 'list-object-versions',
+			'--bucket', bucket,
+			'--max-keys', '1000'
+		]
+		page = json.loads(aws_module.aws_cli_verbose(command + markers, cached=False))
+		versions = page.get("Versions", []) + page.get("DeleteMarkers", [])
+		if len(versions) > 0:
+			yield [ { "Key": v["Key"], "VersionId": v["VersionId"] } for v in versions ]
+		if not page.get("IsTruncated", False):
+			return
+		markers = [ '--key-marker', page["NextKeyMarker"] ]
+		if page.get("NextVersionIdMarker") is not None:
+			markers += [ '--version-id-marker', page["NextVersionIdMarker"] ]
+
+def delete_bucket_objects(bucket, objects, deleted):
 	command = [
-		's3', 'rb',
-		's3://' + bucket
+		's3api', 'delete-objects',
+		'--bucket', bucket,
+		'--delete', json.dumps({ "Objects": objects, "Quiet": True })
 	]
-	aws(command)
+	result = aws_delete(command) or {}
+	errors = result.get("Errors", [])
+	if len(errors) > 0:
+		raise Exception("failed to delete " + str(len(errors)) + " objects from " + bucket + ": " + errors[0].get("Message", ""))
+	with deleted["lock"]:
+		deleted["count"] += len(objects)
 
 def remove_all_buckets():
 	command = [
-		's3', 'ls'
+		's3api', 'list-buckets'
 	]
-	buckets = aws_module.aws_cli_verbose(command)
+	buckets = aws(command)["Buckets"]
+	graph = tasks.TaskGraph(workers=get_workers())
 	for bucket in buckets:
-		line = bucket.split(' ')
-		remove_bucket(line[2])
+		graph.add('bucket:' + bucket["Name"], partial(remove_bucket, bucket["Name"]))
+	run_tasks(graph)
 
-def remove_stack_resources(stack):
-	print "remove stack resources for", stack
+def collect_stack_resources(stack, vpcs, buckets):
+	""" Finds the vpcs and buckets of a stack and all its nested stacks """
+	print "collect stack resources for", stack
 	command = [
 		'cloudformation',
 		'list-stack-resources',
@@ -262,26 +457,40 @@ def remove_stack_resources(stack):
 	]
 	resources = aws(command)["StackResourceSummaries"]
 	stacks =  [ resource["PhysicalResourceId"] for resource in resources if resource["ResourceType"] == "AWS::CloudFormation::Stack"]
-	vpcs =    [ resource["PhysicalResourceId"] for resource in resources if resource["ResourceType"] == "AWS::EC2::VPC"]
-	buckets = [ resource["PhysicalResourceId"] for resource in resources if resource["ResourceType"] == "AWS::S3::Bucket"]
+	vpcs +=    [ resource["PhysicalResourceId"] for resource in resources if resource["ResourceType"] == "AWS::EC2::VPC"]
+	buckets += [ resource["PhysicalResourceId"] for resource in resources if resource["ResourceType"] == "AWS::S3::Bucket"]
 	for substack in stacks:
 		name_parts = substack.split('/')
 		substack = substack if len(name_parts) != 3 else name_parts[1]
-		remove_stack_resources(substack)
-	for vpc in vpcs:
-		remove_vpc(vpc)
-	for bucket in buckets:
-		remove_bucket(bucket)
+		collect_stack_resources(substack, vpcs, buckets)
 
-def remove_stack(stack):
-	remove_stack_resources(stack)
-	print "remove stack", stack
+def add_stack_resources_tasks(graph, stack):
+	vpcs = []
+	buckets = []
+	collect_stack_resources(stack, vpcs, buckets)
+	names  = add_vpcs_tasks(graph, vpcs)
+	names += [ graph.add('bucket:' + bucket, partial(remove_bucket, bucket)) for bucket in buckets ]
+	return names
+
+def remove_stack_resources(stack):
+	graph = tasks.TaskGraph(workers=get_workers())
+	add_stack_resources_tasks(graph, stack)
+	run_tasks(graph)
+
+def remove_stack_only(stack):
+	log("remove stack", stack)
 	command = [
 		'cloudformation',
 		'delete-stack',
 		'--stack-name', stack
 	]
-	aws(command)
+	aws_delete(command)
+
+def remove_stack(stack):
+	graph = tasks.TaskGraph(workers=get_workers())
+	resources = add_stack_resources_tasks(graph, stack)
+	graph.add('stack:' + stack, partial(remove_stack_only, stack), resources)
+	run_tasks(graph)
 	print "remove stack configuration"
 	config.remove_section('stack-' + stack)	
 
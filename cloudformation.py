@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import os
 import sys
+import hashlib
 import pivnet
 import config
 import json
@@ -9,24 +11,34 @@ import cli
 import time, datetime
 import random
 import string
+import collections
+import subprocess
+import tempfile
+import threading
+import Queue
+import tasks
 
 """ CloudFormation API """
 
-def download_template(version, verbose=False):
+def download_template(version, verbose=False, refresh=False):
 	version = config.get('elastic-runtime', 'release', None) if version is None else version
-	product = pivnet.pivnet_select_product('Elastic Runtime')
-	release = pivnet.pivnet_select_release(product, version)
-	version = release["version"]
-	files   = pivnet.pivnet_files(product, release, 'cloudformation')
-	if len(files) < 1:
-		print "no cloudformation template found for release", version
-		sys.exit(1)
-	if len(files) > 1:
-		print "multiple cloudformation templates found for release", version
-		sys.exit(1)
-	if verbose:
-		print "Downloading CloudFormation template for Elastic Runtime version", version
-	template = json.load(pivnet.pivnet_open(files[0]))
+	template = None if refresh or version is None else get_cached_template(version)
+	if template is None:
+		product = pivnet.pivnet_select_product('Elastic Runtime')
+		release = pivnet.pivnet_select_release(product, version)
+		version = release["version"]
+		files   = pivnet.pivnet_files(product, release, 'cloudformation')
+		if len(files) < 1:
+			print "no cloudformation template found for release", version
+			sys.exit(1)
+		if len(files) > 1:
+			print "multiple cloudformation templates found for release", version
+			sys.exit(1)
+		template = None if refresh else get_cached_template(version, files[0])
+		if template is None:
+			if verbose:
+				print "Downloading CloudFormation template for Elastic Runtime version", version
+			template = cache_template(version, files[0])
 	metadata = {
 		"created-by": "rebel",
 		"pcf-version": version,
@@ -34,16 +46,117 @@ def download_template(version, verbose=False):
 	template["Metadata"] = metadata
 	return template
 
+""" Local cache of CloudFormation templates, keyed by PivNet product file id and checksum """
+
+TEMPLATE_INDEX = 'templates/index.json'
+TEMPLATE_CACHE_SIZE = 20
+
+def template_key(file):
+	return pivnet.artifact_key(file)
+
+def get_cached_template(version, file=None):
+	""" Returns the cached template of a release (or of a specific product file), or None """
+	index = config.load_cache(TEMPLATE_INDEX, { "versions": {}, "used": {} })
+	key = template_key(file) if file is not None else index["versions"].get(version)
+	if key is None:
+		return None
+	try:
+		with open(config.cache_path('templates', key + '.json'), 'rb') as template_file:
+			template = json.load(template_file)
+	except (IOError, ValueError):
+		return None
+	index["versions"][version] = key
+	index["used"][key] = time.time()
+	config.save_cache(TEMPLATE_INDEX, index)
+	return template
+
+def cache_template(version, file):
+	""" Downloads a template into the cache, verifying its checksum, and returns it """
+	data = pivnet.pivnet_open(file).read()
+	for algorithm in [ "sha256", "md5" ]:
+		expected = file.get(algorithm)
+		if expected and getattr(hashlib, algorithm)(data).hexdigest() != expected:
+			print "Checksum mismatch for CloudFormation template of release", version
+			sys.exit(1)
+	template = json.loads(data)
+	key = template_key(file)
+	path = config.cache_path('templates', key + '.json')
+	with open(path + '.tmp', 'wb') as template_file:
+		template_file.write(data)
+	os.rename(path + '.tmp', path)
+	index = config.load_cache(TEMPLATE_INDEX, { "versions": {}, "used": {} })
+	index["versions"][version] = key
+	index["used"][key] = time.time()
+	evict_templates(index)
+	config.save_cache(TEMPLATE_INDEX, index)
+	return template
+
+def evict_templates(index):
+	""" Removes the least recently used templates beyond the cache size """
+	size = int(config.get('cache', 'templates', default=None) or TEMPLATE_CACHE_SIZE)
+	keys = sorted(index["used"].keys(), key=lambda key: index["used"][key], reverse=True)
+	for key in keys[size:]:
+		try:
+			os.remove(config.cache_path('templates', key + '.json'))
+		except OSError:
+			pass
+		del index["used"][key]
+	index["versions"] = dict((v, k) for v, k in index["versions"].items() if k in index["used"])
+
+STACK_WORKERS = 8
+
+# All stack states except DELETE_COMPLETE
+LIVE_STACK_STATUSES = [
+	'CREATE_IN_PROGRESS', 'CREATE_FAILED', 'CREATE_COMPLETE',
+	'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+	'DELETE_IN_PROGRESS', 'DELETE_FAILED',
+	'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE',
+	'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
+	'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE',
+]
+
 def list_stacks(stack_pattern = ""):
-	all_stacks = json.loads(aws.aws_cli_verbose(['cloudformation', 'describe-stacks']))["Stacks"]
+	if stack_pattern == "":
+		all_stacks = aws.aws_cli_items(['cloudformation', 'describe-stacks'], 'Stacks')
+		return [s for s in all_stacks if is_rebel_stack(s)]
+	# Only fetch full descriptors (with the tags that identify rebel stacks) for stacks whose name matches
+	command = [
+		'cloudformation',
+		'list-stacks',
+		'--stack-status-filter'
+	] + LIVE_STACK_STATUSES
+	summaries = aws.aws_cli_items(command, 'StackSummaries', [ 'StackId', 'StackName', 'ParentId' ])
+	candidates = [s["StackId"] for s in summaries if stack_pattern in s["StackName"] and s.get("ParentId") is None]
+	all_stacks = [s for s in tasks.parallel_map(describe_stack, candidates, STACK_WORKERS) if s is not None]
 	all_stacks = [s for s in all_stacks if is_rebel_stack(s)]
 	stacks = [s for s in all_stacks if stack_pattern == s["StackName"]]
 	if len(stacks) == 0:
-		stacks = [s for s in all_stacks if stack_pattern in s["StackName"]]
+		stacks = all_stacks
 	return stacks
 
+def describe_stack(stack_name, cached=True):
+	""" Returns the descriptor of a stack by exact name or id, or None if there is no such stack """
+	command = [
+		'cloudformation',
+		'describe-stacks',
+		'--stack-name', stack_name
+	]
+	try:
+		stacks = json.loads(aws.aws_cli(command, cached))["Stacks"]
+	except subprocess.CalledProcessError:
+		return None
+	return index_stack(stacks[0]) if len(stacks) > 0 else None
+
 def select_stack(stack_pattern):
+	stack = get_cached_stack(stack_pattern)
+	if stack is not None:
+		return stack
+	stack = describe_stack(stack_pattern) if stack_pattern != "" else None
+	if stack is not None and stack["StackStatus"] != "DELETE_COMPLETE" and is_rebel_stack(stack):
+		cache_stacks([ stack ])
+		return stack
 	stacks = list_stacks(stack_pattern)
+	cache_stacks(stacks)
 	if len(stacks) < 1:
 		print stack_pattern, "does not match any stacks. Available stacks are:"
 		print "\n".join(["   " + s["StackName"] for s in list_stacks()])
@@ -55,28 +168,178 @@ def select_stack(stack_pattern):
 		sys.exit(1)
 	return stacks[0]
 
-def get_stack(stack_id):
-	stacks = json.loads(aws.aws_cli_verbose(['cloudformation', 'describe-stacks', '--stack-name', stack_id]))["Stacks"]
-	if len(stacks) < 1:
-		print stack_pattern, "does not match any stacks. Available stacks are:"
-		print "\n".join(["   " + s["StackId"] for s in list_stacks()])
-		sys.exit(1)
-	return stacks[0]
+""" Local index of stack ids by name, so commands can find their stack without listing all stacks """
+
+STACK_CACHE = 'stacks.json'
+
+def get_cached_stack(name):
+	""" Returns the descriptor of a stack by exact name, if its id is known """
+	stack_id = load_stack_ids().get(name)
+	if stack_id is None:
+		return None
+	stack = describe_stack(stack_id)
+	if stack is None or stack["StackStatus"] == "DELETE_COMPLETE" or not is_rebel_stack(stack):
+		forget_stack(name)
+		return None
+	return stack
+
+def load_stack_ids():
+	return config.load_cache(STACK_CACHE, { "names": {} })["names"]
+
+def cache_stacks(stacks):
+	names = load_stack_ids()
+	for stack in stacks:
+		if is_rebel_stack(stack):
+			names[stack["StackName"]] = stack["StackId"]
+	config.save_cache(STACK_CACHE, { "names": names })
+
+def forget_stack(name):
+	names = load_stack_ids()
+	names.pop(name, None)
+	config.save_cache(STACK_CACHE, { "names": names })
 
 def create_stack(template, name, sync=True, verbose=False):
+	staged = []
+	try:
+		command = [
+			'cloudformation',
+			'create-stack',
+			'--stack-name', name,
+		] + stage_template(template, name, staged, verbose) + [
+			'--on-failure', 'DO_NOTHING',
+			'--parameters', 'file://' + stage_file(minified(get_parameters(name, template)), staged),
+			'--capabilities', 'CAPABILITY_IAM',
+			'--tags', 'file://' + stage_file(minified(set_tags(template)), staged)
+		]
+		aws.aws_cli_verbose(command)
+	finally:
+		remove_staged(staged)
+	if sync:
+		await_stack(name, verbose)
+
+# Reasons a change set fails for when the stack already matches the template
+NO_CHANGES_REASONS = [ "didn't contain changes", "No updates are to be performed" ]
+
+def update_stack(stack, template, execute=True, sync=True, verbose=False):
+	""" Updates a stack in place through a change set, so only the changed resources are touched
+
+	Returns False if the update failed, and True if it succeeded or there was nothing to update.
+	"""
+	name = stack["StackName"]
+	staged = []
+	try:
+		command = [
+			'cloudformation',
+			'create-change-set',
+			'--stack-name', stack["StackId"],
+			'--change-set-name', 'rebel-' + datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
+			'--change-set-type', 'UPDATE',
+		] + stage_template(template, name, staged, verbose) + [
+			'--parameters', 'file://' + stage_file(minified(get_update_parameters(stack, template)), staged),
+			'--capabilities', 'CAPABILITY_IAM',
+			'--tags', 'file://' + stage_file(minified(set_tags(template)), staged)
+		]
+		change_set_id = json.loads(aws.aws_cli_verbose(command))["Id"]
+	finally:
+		remove_staged(staged)
+	change_set = await_change_set(change_set_id)
+	if change_set["Status"] == "FAILED":
+		aws.aws_cli_verbose(['cloudformation', 'delete-change-set', '--change-set-name', change_set_id])
+		reason = change_set.get("StatusReason", "change set failed")
+		if any(text in reason for text in NO_CHANGES_REASONS):
+			print "Stack", name, "is already up to date"
+			return True
+		print "Stack", name, "was not updated:", reason
+		return False
+	print_changes(change_set.get("Changes", []))
+	if not execute:
+		aws.aws_cli_verbose(['cloudformation', 'delete-change-set', '--change-set-name', change_set_id])
+		return True
+	aws.aws_cli_verbose(['cloudformation', 'execute-change-set', '--change-set-name', change_set_id])
+	if sync:
+		status = await_stack(name, verbose)
+		if status != "UPDATE_COMPLETE":
+			print "Stack", name, "was not updated:", friendly_status(status or "DELETE_COMPLETE")
+			return False
+	return True
+
+def get_update_parameters(stack, template):
+	""" Like get_parameters, but keeps the generated credentials the stack was created with """
+	previous = index_stack(stack)["ParameterMap"]
+	parameters = []
+	for parameter in get_parameters(stack["StackName"], template):
+		if parameter["ParameterKey"] in previous and friendly_name(parameter["ParameterKey"]) in [ 'rds-username', 'rds-password' ]:
+			parameter = { "ParameterKey": parameter["ParameterKey"], "UsePreviousValue": True }
+		parameters.append(parameter)
+	return parameters
+
+def await_change_set(change_set_id):
+	""" Waits for a change set to be computed, and returns it with the changes of all pages """
 	command = [
 		'cloudformation',
-		'create-stack',
-		'--stack-name', name,
-		'--template-body', json.dumps(template),
-		'--on-failure', 'DO_NOTHING',
-		'--parameters', json.dumps(get_parameters(name, template)),
-		'--capabilities', 'CAPABILITY_IAM',
-		'--tags', json.dumps(set_tags(template))
+		'describe-change-set',
+		'--change-set-name', change_set_id
 	]
-	aws.aws_cli_verbose(command)
-	if sync:
-		await_stack(name, verbose)
+	while True:
+		change_set = json.loads(aws.aws_cli_verbose(command, cached=False))
+		if change_set["Status"] not in [ "CREATE_PENDING", "CREATE_IN_PROGRESS" ]:
+			break
+		time.sleep(MIN_POLL_INTERVAL)
+	# aws_cli turns off the CLI's own pagination, so the remaining pages of changes are fetched here
+	page = change_set
+	while page.get("NextToken") is not None:
+		page = json.loads(aws.aws_cli_verbose(command + [ '--next-token', page["NextToken"] ], cached=False))
+		change_set.setdefault("Changes", []).extend(page.get("Changes", []))
+	return change_set
+
+def print_changes(changes):
+	for change in changes:
+		resource = change.get("ResourceChange", {})
+		replacement = { "True": " (replace)", "Conditional": " (may replace)" }.get(resource.get("Replacement"), "")
+		print "   %-8s %s [%s]%s" % (resource.get("Action", "").lower(), resource.get("LogicalResourceId"), resource.get("ResourceType"), replacement)
+
+""" Templates, parameters and tags are passed by file or S3 URL, as they can be too large for the command line """
+
+TEMPLATE_BODY_LIMIT = 51200
+
+def minified(value):
+	return json.dumps(value, separators=(',', ':'))
+
+def stage_file(body, staged):
+	""" Writes body to a temporary file, remembered in staged for removal, and returns its path """
+	fd, path = tempfile.mkstemp(prefix='rebel-', suffix='.json')
+	staged.append(path)
+	with os.fdopen(fd, 'w') as f:
+		f.write(body)
+	return path
+
+def remove_staged(staged):
+	for path in staged:
+		os.remove(path)
+
+def stage_template(template, name, staged, verbose=False):
+	""" Returns the stack command options that pass the template, inline up to the CloudFormation limit """
+	body = minified(template)
+	if len(body) <= TEMPLATE_BODY_LIMIT:
+		return [ '--template-body', 'file://' + stage_file(body, staged) ]
+	return [ '--template-url', upload_template(body, name, staged, verbose) ]
+
+def upload_template(body, name, staged, verbose=False):
+	""" Uploads a template to the staging bucket, creating that if needed, and returns its URL """
+	region = aws.aws_cli_verbose(['configure', 'get', 'region']).strip()
+	bucket = config.get('aws', 'template-bucket', default=None)
+	if bucket is None:
+		account = json.loads(aws.aws_cli_verbose(['sts', 'get-caller-identity']))["Account"]
+		bucket = 'rebel-templates-' + account + '-' + region
+	if bucket not in aws.aws_cli_verbose(['s3', 'ls']).split():
+		if verbose:
+			print "Creating bucket", bucket, "for staging CloudFormation templates"
+		aws.aws_cli_verbose(['s3', 'mb', 's3://' + bucket, '--region', region])
+	key = name + '/' + hashlib.sha256(body).hexdigest() + '.json'
+	if verbose:
+		print "Uploading CloudFormation template to s3://" + bucket + '/' + key
+	aws.aws_cli_verbose(['s3', 'cp', stage_file(body, staged), 's3://' + bucket + '/' + key, '--quiet'])
+	return aws.get_s3_endpoint(region).replace('http://', 'https://', 1) + '/' + bucket + '/' + key
 
 def delete_stack(stack, sync=True, verbose=False):
 	name = stack["StackName"]
@@ -88,39 +351,315 @@ def delete_stack(stack, sync=True, verbose=False):
 	aws.aws_cli_verbose(command)
 	if sync:
 		await_stack(name, verbose)
+	forget_stack(name)
 	config.remove_section("stack-" + name)
 
+MIN_POLL_INTERVAL = 2
+TRANSITION_POLL_INTERVAL = 10
+MAX_POLL_INTERVAL = 30
+EVENT_PAGE_SIZE = 25
+# Stack states that a create, update or delete of the stack starts with
+OPERATION_START_STATUSES = [ 'CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'DELETE_IN_PROGRESS' ]
+
 def await_stack(name, verbose=False):
-	""" Wait for in-progress state to clear """
+	""" Wait for in-progress state to clear, and return the status the stack ends up in """
 	starttime = datetime.datetime.now()
 	stack = select_stack(name)
-	in_progress = True
-	resources = {}
-	while in_progress:
-		in_progress = update_stack_resources(stack, resources, starttime, verbose)
-		time.sleep(5)
+	if not verbose:
+		# Without progress to show, only the status matters, which the shared poller provides
+		return get_stack_poller().wait(stack["StackId"], stack["StackStatus"])
+	watch = watch_stack(stack)
+	interval = MIN_POLL_INTERVAL
+	while update_stack_resources(watch, starttime, verbose):
+		interval = next_poll_interval(interval, watch)
+		time.sleep(interval)
+	return watch["status"]
 
-def update_stack_resources(stack, oldresources, starttime, verbose=False):
+""" Status of all stacks that are waited for, polled with one list-stacks call per interval """
+
+STATUS_POLL_INTERVAL = 10
+STATUS_SNAPSHOT = 'stack-statuses.json'
+# Seconds that statuses are kept in the snapshot after they were last listed
+STATUS_RETENTION = 300
+
+class StackPoller(threading.Thread):
+	""" Polls the status of any number of stacks at once, and tells each subscriber about its transitions
+
+	Subscribers are called from the poller thread with the stack id and its new status. Across
+	processes, polls are shared through a snapshot in the local cache (see get_stack_statuses).
+	"""
+
+	def __init__(self, interval=STATUS_POLL_INTERVAL):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.interval = interval
+		self.subscribers = collections.defaultdict(list)
+		self.statuses = {}
+		self.lock = threading.Lock()
+
+	def subscribe(self, stack_id, status, callback):
+		with self.lock:
+			self.statuses.setdefault(stack_id, status)
+			self.subscribers[stack_id].append(callback)
+			if not self.is_alive():
+				self.start()
+
+	def unsubscribe(self, stack_id, callback):
+		with self.lock:
+			self.subscribers[stack_id].remove(callback)
+			if len(self.subscribers[stack_id]) == 0:
+				del self.subscribers[stack_id]
+				del self.statuses[stack_id]
+
+	def wait(self, stack_id, status, on_transition=None):
+		""" Blocks until the stack is no longer in progress, and returns its final status """
+		transitions = Queue.Queue()
+		callback = lambda stack_id, status: transitions.put(status)
+		self.subscribe(stack_id, status, callback)
+		try:
+			while is_in_progress(status):
+				status = transitions.get()
+				if on_transition is not None:
+					on_transition(stack_id, status)
+		finally:
+			self.unsubscribe(stack_id, callback)
+		return status
+
+	def run(self):
+		while True:
+			time.sleep(self.interval)
+			with self.lock:
+				stack_ids = self.subscribers.keys()
+			if len(stack_ids) < 1:
+				continue
+			try:
+				statuses = get_stack_statuses(stack_ids, self.interval)
+			except (SystemExit, Exception):
+				# A failed poll is retried at the next interval, rather than ending the thread
+				continue
+			for stack_id, status in statuses.items():
+				with self.lock:
+					if stack_id not in self.statuses or self.statuses[stack_id] == status:
+						continue
+					self.statuses[stack_id] = status
+					callbacks = list(self.subscribers[stack_id])
+				for callback in callbacks:
+					callback(stack_id, status)
+
+STACK_POLLER = None
+STACK_POLLER_LOCK = threading.Lock()
+
+def get_stack_poller():
+	global STACK_POLLER
+	with STACK_POLLER_LOCK:
+		if STACK_POLLER is None:
+			STACK_POLLER = StackPoller()
+		return STACK_POLLER
+
+def is_in_progress(status):
+	return status is not None and status.endswith("_IN_PROGRESS")
+
+def get_stack_statuses(stack_ids, max_age):
+	""" Returns the status of the given stacks (None for stacks that no longer exist)
+
+	Processes that wait for stacks at the same time share a snapshot of the statuses under a lock,
+	so that only one of them calls list-stacks per interval, however many stacks they wait for.
+	Each process merges what it lists into the snapshot, which keeps every status with the time
+	it was listed, until nobody has asked for it for a while.
+	"""
+	with config.cache_lock(STATUS_SNAPSHOT):
+		snapshot = config.load_cache(STATUS_SNAPSHOT, { "stacks": {} })
+		entries = snapshot["stacks"]
+		now = time.time()
+		stale = [ stack_id for stack_id in stack_ids if stack_id not in entries or now - entries[stack_id]["time"] >= max_age ]
+		if len(stale) > 0:
+			statuses = list_stack_statuses(stale)
+			for stack_id in set(stale) | (set(statuses.keys()) & set(entries.keys())):
+				entries[stack_id] = { "status": statuses.get(stack_id), "time": now }
+			for stack_id in [ stack_id for stack_id, entry in entries.items() if now - entry["time"] >= STATUS_RETENTION and stack_id not in stack_ids ]:
+				del entries[stack_id]
+			config.save_cache(STATUS_SNAPSHOT, snapshot)
+	return dict((stack_id, entries[stack_id]["status"]) for stack_id in stack_ids)
+
+def list_stack_statuses(stack_ids):
+	""" Lists stack statuses, only as far as needed to find all the given stacks """
+	wanted = set(stack_ids)
+	statuses = {}
+	for summary in aws.aws_cli_items(['cloudformation', 'list-stacks'], 'StackSummaries', [ 'StackId', 'StackStatus' ], cached=False):
+		statuses[summary["StackId"]] = summary["StackStatus"]
+		wanted.discard(summary["StackId"])
+		if len(wanted) == 0:
+			break
+	return statuses
+
+def await_stacks(names):
+	""" Waits for several stacks at once, showing their status transitions """
+	starttime = datetime.datetime.now()
+	stacks = [ select_stack(name) for name in names ]
+	names = dict((stack["StackId"], stack["StackName"]) for stack in stacks)
+	show = lambda stack_id, status: tasks.log(friendly_delta(datetime.datetime.now() - starttime), names[stack_id], friendly_status(status))
+	poller = get_stack_poller()
+	wait = lambda stack: poller.wait(stack["StackId"], stack["StackStatus"], show)
+	return tasks.parallel_map(wait, stacks, len(stacks))
+
+def await_outputs(name, keys, verbose=False):
+	""" Returns the values of the given outputs as soon as the resources they reference are created
+
+	Outputs that directly reference a resource of the stack itself are resolved from the physical
+	id of that resource, which is often known long before the whole stack is created. Otherwise
+	this waits for the stack to finish, like await_stack.
+	"""
+	stack = select_stack(name)
+	if stack["StackStatus"] == "CREATE_IN_PROGRESS":
+		refs = get_output_refs(stack["StackId"])
+		logical_ids = [ refs.get(key) for key in keys ]
+		physical_ids = await_stack_resources(stack, logical_ids, verbose) if None not in logical_ids else None
+		if physical_ids is not None:
+			return dict((key, physical_ids[logical_id]) for key, logical_id in zip(keys, logical_ids))
+		await_stack(name, verbose)
+		# The stack was described when the wait started, and that may still be in the response cache
+		stack = describe_stack(stack["StackId"], cached=False)
+	return dict((key, get_output(stack, key)) for key in keys)
+
+def get_output_refs(stack_id):
+	""" Returns the logical ids of the resources that outputs of the stack reference with Ref """
+	template = json.loads(aws.aws_cli_verbose(['cloudformation', 'get-template', '--stack-name', stack_id]))["TemplateBody"]
+	template = json.loads(template) if isinstance(template, basestring) else template
+	refs = {}
+	for key, output in template.get("Outputs", {}).items():
+		value = output.get("Value")
+		if isinstance(value, dict) and value.keys() == [ "Ref" ]:
+			refs[key] = value["Ref"]
+	return refs
+
+def await_stack_resources(stack, logical_ids, verbose=False):
+	""" Waits for resources of a stack that is being created, and returns their physical ids by logical id
+
+	Returns None if the stack stops being in progress before all of the resources are created.
+	"""
+	starttime = datetime.datetime.now()
 	stack_id = stack["StackId"]
-	stack_status = get_stack(stack_id)["StackStatus"]
-	in_progress = stack_status.endswith("_IN_PROGRESS")
-	if verbose:
-		line_length = 120
-		blank_line = ' ' * line_length + '\r'
-		operation = friendly_status(stack_status)
-		partials = []
-		newresources = get_stack_resources(stack_id)
-		since = datetime.datetime.now() - starttime
-		for newresource in newresources:
-			resource_id = newresource["LogicalResourceId"]
-			newstatus   = newresource["ResourceStatus"]
-			oldresource = oldresources.get(resource_id, None)
-			if newstatus.endswith("_IN_PROGRESS"):
-				partials.append(resource_id)
-			elif oldresource is not None and oldresource["ResourceStatus"] != newstatus:
+	watch = watch_stack(stack)
+	created = {}
+	for resource in list_stack_resources(stack_id, cached=False):
+		if resource["LogicalResourceId"] in logical_ids and resource["ResourceStatus"] == "CREATE_COMPLETE":
+			created[resource["LogicalResourceId"]] = resource["PhysicalResourceId"]
+	interval = MIN_POLL_INTERVAL
+	while True:
+		in_progress = update_stack_resources(watch, starttime, verbose)
+		for logical_id in logical_ids:
+			event = watch["resources"].get((stack_id, logical_id))
+			if event is not None and event["ResourceStatus"] == "CREATE_COMPLETE":
+				created[logical_id] = event["PhysicalResourceId"]
+		if len(created) == len(set(logical_ids)):
+			return created
+		if not in_progress:
+			return None
+		interval = next_poll_interval(interval, watch)
+		time.sleep(interval)
+
+def next_poll_interval(interval, watch):
+	""" Poll quickly while events come in, and back off gradually when nothing changes """
+	if watch["changed"]:
+		return MIN_POLL_INTERVAL
+	transitioning = len(partial_resources(watch)) > 0
+	return min(interval * 1.5, TRANSITION_POLL_INTERVAL if transitioning else MAX_POLL_INTERVAL)
+
+def watch_stack(stack):
+	""" Starts following the events of a stack and of its nested stacks that are in progress or show up later """
+	stack_id = stack["StackId"]
+	watch = {
+		"stack_id": stack_id,
+		"status": stack["StackStatus"],
+		"since": None,
+		"cursors": collections.OrderedDict([ (stack_id, None) ]),
+		"resources": collections.OrderedDict(),
+		"changed": False,
+	}
+	command = [
+		'cloudformation',
+		'describe-stack-events',
+		'--stack-name', stack_id
+	]
+	# Events of the operation in progress are read back to where it started, so that resources
+	# and nested stacks that are still in progress are known however many events there were
+	events = []
+	for event in aws.aws_cli_items(command, 'StackEvents', page_size=EVENT_PAGE_SIZE, cached=False):
+		events.append(event)
+		if not is_in_progress(stack["StackStatus"]) or is_operation_start(event):
+			break
+	if len(events) > 0:
+		watch["cursors"][stack_id] = events[0]["EventId"]
+		watch["since"] = events[0]["Timestamp"]
+	for event in reversed(events):
+		apply_stack_event(watch, event, follow=False)
+	# Nested stacks that are still being worked on are followed from the start
+	for resource in watch["resources"].values():
+		physical_id = resource.get("PhysicalResourceId")
+		if resource["ResourceType"] == 'AWS::CloudFormation::Stack' and physical_id and resource["ResourceStatus"].endswith("_IN_PROGRESS"):
+			if physical_id not in watch["cursors"]:
+				watch["cursors"][physical_id] = None
+	return watch
+
+def is_operation_start(event):
+	return event.get("PhysicalResourceId") == event["StackId"] and event["ResourceStatus"] in OPERATION_START_STATUSES
+
+def get_new_stack_events(stack_id, cursor, since):
+	""" Returns the events of a stack after the cursor event (and not before since), oldest first
+
+	Pages of events are read until the cursor is reached, however many events came in since.
+	"""
+	command = [
+		'cloudformation',
+		'describe-stack-events',
+		'--stack-name', stack_id
+	]
+	events = []
+	for event in aws.aws_cli_items(command, 'StackEvents', page_size=EVENT_PAGE_SIZE, cached=False):
+		if event["EventId"] == cursor or (since is not None and event["Timestamp"] < since):
+			break
+		events.append(event)
+	events.reverse()
+	return events
+
+def apply_stack_event(watch, event, follow=True):
+	physical_id = event.get("PhysicalResourceId")
+	if physical_id == event["StackId"]:
+		# Status change of a stack itself rather than of one of its resources
+		if physical_id == watch["stack_id"]:
+			watch["status"] = event["ResourceStatus"]
+		return
+	if follow and event["ResourceType"] == 'AWS::CloudFormation::Stack' and physical_id:
+		if physical_id not in watch["cursors"]:
+			watch["cursors"][physical_id] = None
+	watch["resources"][(event["StackId"], event["LogicalResourceId"])] = event
+
+def partial_resources(watch):
+	return [ r["LogicalResourceId"] for r in watch["resources"].values() if r["ResourceStatus"].endswith("_IN_PROGRESS") ]
+
+def update_stack_resources(watch, starttime, verbose=False):
+	""" Fetches only the events that are new since the previous update, and shows progress """
+	line_length = 120
+	blank_line = ' ' * line_length + '\r'
+	since = datetime.datetime.now() - starttime
+	watch["changed"] = False
+	stack_ids = watch["cursors"].keys() if verbose else [ watch["stack_id"] ]
+	for stack_id in stack_ids:
+		events = get_new_stack_events(stack_id, watch["cursors"][stack_id], watch["since"])
+		if len(events) < 1:
+			continue
+		watch["cursors"][stack_id] = events[-1]["EventId"]
+		watch["changed"] = True
+		for event in events:
+			apply_stack_event(watch, event, follow=verbose)
+			status = event["ResourceStatus"]
+			if verbose and event.get("PhysicalResourceId") != event["StackId"] and not status.endswith("_IN_PROGRESS"):
 				sys.stdout.write(blank_line)
-				print friendly_delta(since), friendly_status(newstatus), resource_id
-			oldresources[resource_id] = newresource
+				print friendly_delta(since), friendly_status(status), event["LogicalResourceId"]
+	in_progress = watch["status"].endswith("_IN_PROGRESS")
+	if verbose:
+		operation = friendly_status(watch["status"])
+		partials = partial_resources(watch)
 		if len(partials) > 0:
 			partials_line = friendly_delta(since) + " " + operation + " " + ", ".join(partials)
 			partials_line = (partials_line[:line_length - 3] + '...') if len(partials_line) > line_length else partials_line
@@ -129,15 +668,31 @@ def update_stack_resources(stack, oldresources, starttime, verbose=False):
 			sys.stdout.flush()
 	return in_progress
 
-def get_stack_resources(stack_id):
-	resources = json.loads(aws.aws_cli_verbose(['cloudformation', 'list-stack-resources', '--stack-name', stack_id]))["StackResourceSummaries"]
-	for resource in resources:
-		if resource["ResourceType"] == 'AWS::CloudFormation::Stack':
-			substack_id = resource.get("PhysicalResourceId", None)
-			if substack_id is not None:
-				resources.extend(get_stack_resources(substack_id))
+def get_stack_resources(stack_id, cached=True):
+	""" Lists the resources of a stack and all its nested stacks, one level of nesting at a time """
+	resources = []
+	visited = set([ stack_id ])
+	level = [ stack_id ]
+	while len(level) > 0:
+		listings = tasks.parallel_map(lambda s: list_stack_resources(s, cached), level, STACK_WORKERS)
+		level = []
+		for listing in listings:
+			resources += listing
+			for resource in listing:
+				substack_id = resource.get("PhysicalResourceId", None)
+				if resource["ResourceType"] == 'AWS::CloudFormation::Stack' and substack_id and substack_id not in visited:
+					visited.add(substack_id)
+					level.append(substack_id)
 	return resources
 
+def list_stack_resources(stack_id, cached=True):
+	command = [
+		'cloudformation',
+		'list-stack-resources',
+		'--stack-name', stack_id
+	]
+	return list(aws.aws_cli_items(command, 'StackResourceSummaries', cached=cached))
+
 def set_tags(template):
 	""" AWS limits us to 10 """
 	tags = [
@@ -147,14 +702,18 @@ def set_tags(template):
 	return tags
 
 def get_tag(stack, key):
-	tags = stack["Tags"]
-	tag = next((t for t in tags if t["Key"] == key), None)
-	return tag["Value"] if tag is not None else None
+	return index_stack(stack)["TagMap"].get(key)
 
 def get_output(stack, key):
-	outputs = stack["Outputs"]
-	output = next((o for o in outputs if o["OutputKey"] == key), None)
-	return output["OutputValue"] if output is not None else None
+	return index_stack(stack)["OutputMap"].get(key)
+
+def index_stack(stack):
+	""" Adds dicts of outputs, tags and parameters to a stack descriptor, for direct lookups """
+	if "OutputMap" not in stack:
+		stack["OutputMap"]    = dict((o["OutputKey"], o["OutputValue"]) for o in stack.get("Outputs", []))
+		stack["TagMap"]       = dict((t["Key"], t["Value"]) for t in stack.get("Tags", []))
+		stack["ParameterMap"] = dict((p["ParameterKey"], p.get("ParameterValue")) for p in stack.get("Parameters", []))
+	return stack
 
 def is_rebel_stack(stack):
 	if not get_tag(stack, "created-by") == "rebel":
@@ -250,13 +809,32 @@ def list_resources_cmd(argv):
 	print "\n".join([friendly_status(r["ResourceStatus"]) + " " + r["LogicalResourceId"] for r in resources])
 
 def create_stack_cmd(argv):
+	refresh = "--refresh" in argv
+	argv = [arg for arg in argv if arg != "--refresh"]
 	cli.exit_with_usage(argv) if len(argv) < 2 else None
 	verify_region()
 	stack_name = argv[1]
 	release = argv[2] if len(argv) > 2 else None
-	template = download_template(release, verbose=True)
+	template = download_template(release, verbose=True, refresh=refresh)
 	create_stack(template, stack_name, verbose=True)
 
+def update_stack_cmd(argv):
+	refresh = "--refresh" in argv
+	dry_run = "--dry-run" in argv
+	argv = [arg for arg in argv if arg not in [ "--refresh", "--dry-run" ]]
+	cli.exit_with_usage(argv) if len(argv) < 2 else None
+	verify_region()
+	stack = select_stack(argv[1])
+	release = argv[2] if len(argv) > 2 else get_tag(stack, "pcf-version")
+	template = download_template(release, verbose=True, refresh=refresh)
+	return 0 if update_stack(stack, template, execute=not dry_run, verbose=True) else 1
+
+def await_stacks_cmd(argv):
+	cli.exit_with_usage(argv) if len(argv) < 2 else None
+	statuses = await_stacks(argv[1:])
+	failed = [ status for status in statuses if status is not None and status not in [ "CREATE_COMPLETE", "UPDATE_COMPLETE", "DELETE_COMPLETE" ] ]
+	return 1 if len(failed) > 0 else 0
+
 def delete_stack_cmd(argv):
 	cli.exit_with_usage(argv) if len(argv) < 2 else None
 	stack_name = argv[1]
@@ -271,16 +849,20 @@ def show_outputs_cmd(argv):
 	print "\n".join([o["OutputKey"] + ": " + o["OutputValue"] for o in outputs])
 
 def show_template_cmd(argv):
+	refresh = "--refresh" in argv
+	argv = [arg for arg in argv if arg != "--refresh"]
 	release = argv[1] if len(argv) > 1 else None
-	template = download_template(release)
+	template = download_template(release, refresh=refresh)
 	print json.dumps(template, indent=4)
 
 commands = {
 	"stacks":       { "func": list_stacks_cmd,    "usage": "stacks [<stack-name>]" },
-	"create-stack": { "func": create_stack_cmd,   "usage": "create-stack <stack-name> [<release>]" },
+	"create-stack": { "func": create_stack_cmd,   "usage": "create-stack <stack-name> [<release>] [--refresh]" },
+	"update-stack": { "func": update_stack_cmd,   "usage": "update-stack <stack-name> [<release>] [--refresh] [--dry-run]" },
 	"delete-stack": { "func": delete_stack_cmd,   "usage": "delete-stack <stack-name>" },
+	"await":        { "func": await_stacks_cmd,   "usage": "await <stack-name>..." },
 	"resources":    { "func": list_resources_cmd, "usage": "resources <stack-name>" },
-	"template":     { "func": show_template_cmd,  "usage": "template [<release>]" },
+	"template":     { "func": show_template_cmd,  "usage": "template [<release>] [--refresh]" },
 	"outputs":      { "func": show_outputs_cmd,   "usage": "outputs <stack-name>" },
 }
 
@@ -2,9 +2,15 @@
 
 import os
 import sys
+import json
+import errno
+import fcntl
+import tempfile
+import contextlib
 import ConfigParser
 
 CONFIG_FILE = os.path.expanduser("~/.rebel.cfg")
+CACHE_DIR = os.path.expanduser("~/.rebel-cache")
 CONFIG = None
 UNSPECIFIED = {}
 
@@ -76,6 +82,47 @@ def remove_section(section):
 	CONFIG.remove_section(section)
 	save_config()
 
+def cache_path(*names):
+	""" Returns the path of a file in the local cache directory, creating its directory if needed """
+	path = os.path.join(CACHE_DIR, *names)
+	try:
+		os.makedirs(os.path.dirname(path), 0700)
+	except os.error, e:
+		if e.errno != errno.EEXIST:
+			raise
+	return path
+
+def load_cache(name, default):
+	try:
+		with open(cache_path(name), 'rb') as cache_file:
+			return json.load(cache_file)
+	except (IOError, ValueError):
+		return default
+
+def save_cache(name, value):
+	""" Atomically replaces a cache file, readable only by the current user """
+	path = cache_path(name)
+	fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+	with os.fdopen(fd, 'wb') as cache_file:
+		json.dump(value, cache_file)
+	os.rename(temp_path, path)
+
+@contextlib.contextmanager
+def cache_lock(name, blocking=True):
+	""" Holds an exclusive lock on a name in the local cache, shared with other processes
+
+	Yields whether the lock is held, which without blocking is False when someone else holds it.
+	"""
+	with open(cache_path(name + '.lock'), 'a') as lock_file:
+		try:
+			fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError as error:
+			if error.errno not in [ errno.EAGAIN, errno.EACCES ]:
+				raise
+			yield False
+			return
+		yield True
+
 def main(argv):
 
 	""" Pre-configure rebel with all required values so that it can run unattended later """
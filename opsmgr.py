@@ -30,7 +30,7 @@ def opsmgr_list_images(region = None):
 	]
 	if region is not None:
 		command.extend(['--region', region])
-	images = json.loads(aws.aws_cli_verbose(command))["Images"]
+	images = aws.aws_cli_items(command, 'Images', [ 'ImageId', 'Name', 'Description', 'CreationDate' ])
 	images = sorted(images, key=lambda image: image["CreationDate"])
 	images.reverse()
 	return images
@@ -50,7 +50,7 @@ def opsmgr_launch_instance(stack, version=None, verbose=False):
 	version = cloudformation.get_tag(stack, "pcf-version") if version is None else version
 	image = opsmgr_select_image(version, verbose)
 	if verbose:
-		print "Launching Ops Manager instance from", image["ImageId"] + ":", image.get("Description", "-")
+		print "Launching Ops Manager instance from", image["ImageId"] + ":", image.get("Description") or "-"
 	command = [
 		'ec2',
 		'run-instances',
@@ -66,7 +66,7 @@ def opsmgr_launch_instance(stack, version=None, verbose=False):
 	tags = [
 		{ "Key": "Name", "Value": "Ops Manager" },
 		{ "Key": "Stack", "Value": stack["StackName"] },
-		{ "Key": "Image", "Value": image.get("Description", "-") }
+		{ "Key": "Image", "Value": image.get("Description") or "-" }
 	]
 	command = [
 		'ec2',
@@ -89,7 +89,7 @@ def opsmgr_terminate_instances(stack):
 	]
 	aws.aws_cli_verbose(command + instance_ids)
 
-def opsmgr_find_instances(stack=None):
+def opsmgr_find_instances(stack=None, cached=True):
 	filters = [
 		{ "Name": "tag:Name", "Values": [ "Ops Manager" ] },
 		{ "Name": "tag-key",  "Values": [ "Stack" ] },
@@ -102,14 +102,14 @@ def opsmgr_find_instances(stack=None):
 		'describe-instances',
 		'--filters', json.dumps(filters)
 	]
-	reservations = json.loads(aws.aws_cli_verbose(command))["Reservations"]
+	reservations = json.loads(aws.aws_cli_verbose(command, cached))["Reservations"]
 	instances = []
 	for r in reservations:
 		instances += r["Instances"]
 	return instances
 
-def opsmgr_select_instance(stack):
-	instances = opsmgr_find_instances(stack)
+def opsmgr_select_instance(stack, cached=True):
+	instances = opsmgr_find_instances(stack, cached)
 	if len(instances) < 1:
 		print stack["StackName"], "does not have an Ops Manager instance"
 		sys.exit(1)
@@ -122,6 +122,9 @@ def opsmgr_get_tag(instance, key):
 
 def opsmgr_hostname(stack):
 	instance = opsmgr_select_instance(stack)
+	if not instance.get("PublicDnsName"):
+		# A pending instance may not have its public name yet, so don't trust the cache
+		instance = opsmgr_select_instance(stack, cached=False)
 	return instance["PublicDnsName"]
 
 def opsmgr_url(stack):
@@ -329,7 +332,7 @@ def opsmgr_import_product(stack, product, release):
 		if not download_filename.endswith(".pivotal"):
 			continue
 		download_filename = folder + "/" + download_filename
-		download_url = file["_links"]["download"]["href"]
+		download_url = pivnet.pivnet_download_href(file)
 		print "Downloading file", download_filename
 		command = [
 			'wget', '-q',
@@ -437,7 +440,7 @@ def opsmgr_import_stemcell(stack, stemcell):
 		if not is_pattern in download_filename:
 			continue
 		download_filename = folder + "/" + download_filename
-		download_url = file["_links"]["download"]["href"]
+		download_url = pivnet.pivnet_download_href(file)
 		print "Downloading stemcell", download_filename
 		command = [
 			'wget', '-q',
@@ -470,15 +473,29 @@ def list_images_cmd(argv):
 	print "\n".join([i["ImageId"] + " " + i["Name"] for i in images])
 
 def launch_cmd(argv):
+	early = "--early" in argv
+	argv = [arg for arg in argv if arg != "--early"]
 	cli.exit_with_usage(argv) if len(argv) < 2 else None
 	stack_name = argv[1]
 	version = argv[2] if len(argv) > 2 else ""
 	stack = cloudformation.select_stack(stack_name)
+	if early:
+		# Launch as soon as the subnet and security group exist, while the rest of the stack is still being created
+		print "Waiting for the Ops Manager subnet and security group of", stack_name
+		outputs = cloudformation.await_outputs(stack_name, [ "PcfPublicSubnetId", "PcfOpsManagerSecurityGroupId" ], verbose=True)
+		stack["OutputMap"].update(outputs)
 	instance = opsmgr_launch_instance(stack, version, verbose=True)
 	print "Waiting for Ops Manager to start ",
 	opsmgr_wait(stack, verbose=True)
 	print "Setting up initial Admin user"
 	opsmgr_setup(stack)
+	if stack["StackStatus"].endswith("_IN_PROGRESS"):
+		print "Waiting for stack", stack_name, "to be created"
+		cloudformation.await_stack(stack_name, verbose=True)
+		stack = cloudformation.describe_stack(stack["StackId"], cached=False)
+		if stack["StackStatus"] not in [ "CREATE_COMPLETE", "UPDATE_COMPLETE" ]:
+			print "Stack", stack_name, "was not created:", cloudformation.friendly_status(stack["StackStatus"])
+			sys.exit(1)
 	print "Configuring Ops Manager Director"
 	bosh.bosh_config(stack)
 
@@ -590,7 +607,7 @@ def metadata_cmd(argv):
 
 commands = {
 	"images":    { "func": list_images_cmd,    "usage": "images [<region>]" },
-	"launch":    { "func": launch_cmd,         "usage": "launch <stack-name> [<version>]" },
+	"launch":    { "func": launch_cmd,         "usage": "launch <stack-name> [<version>] [--early]" },
 	"instances": { "func": list_instances_cmd, "usage": "instances" },
 	"terminate": { "func": terminate_cmd,      "usage": "terminate <stack-name>" },
 	"settings":  { "func": settings_cmd,       "usage": "settings <stack-name>" },
@@ -3,13 +3,33 @@
 import sys
 import config
 import urllib, urllib2
+import urlparse
+import httplib
+import socket
+import threading
+import hashlib
+import sqlite3
+import time
+import zlib
 import json
 import os.path
+import shutil
 import errno
+import re
+import BaseHTTPServer
+import SocketServer
 import cli
+import tasks
+from StringIO import StringIO
 
 """ Pivotal Network API """
 
+PIVNET_API_URL = 'https://network.pivotal.io/api/v2'
+PIVNET_CACHE = 'pivnet'
+
+def pivnet_api_url():
+	return (config.get('pivotal-network', 'api-url', default=None) or PIVNET_API_URL).rstrip('/')
+
 def pivnet_request(url):
 	PIVNET_TOKEN = config.get('pivotal-network', 'token')
 	request = urllib2.Request(url)
@@ -18,19 +38,103 @@ def pivnet_request(url):
 	request.add_header('Accept', 'application/json')
 	return request
 
+""" API calls share one keep-alive connection per thread and host, and responses are cached on disk
+
+Cached responses are revalidated with their ETag or Last-Modified date, so that unchanged
+listings come back as an empty 304 response instead of being downloaded again.
+"""
+
+CONNECTIONS = threading.local()
+HTTP_TIMEOUT = 60
+
+def pivnet_connection(scheme, netloc, fresh=False):
+	connections = CONNECTIONS.__dict__.setdefault("connections", {})
+	key = (scheme, netloc)
+	if fresh and key in connections:
+		connections.pop(key).close()
+	if key not in connections:
+		connection_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+		proxy = urllib.getproxies().get(scheme)
+		if proxy is not None and not urllib.proxy_bypass(netloc.split(':')[0]):
+			connection = connection_class(urlparse.urlparse(proxy).netloc, timeout=HTTP_TIMEOUT)
+			connection.set_tunnel(netloc)
+		else:
+			connection = connection_class(netloc, timeout=HTTP_TIMEOUT)
+		connections[key] = connection
+	return connections[key]
+
+def http_request(method, url, body=None, headers={}):
+	""" Sends a request over this thread's keep-alive connection to the host of url, and returns the response """
+	parts = urlparse.urlparse(url)
+	path = parts.path + ('?' + parts.query if parts.query else '')
+	for attempt in range(2):
+		# A kept-alive connection may have been closed by the server since it was last used
+		connection = pivnet_connection(parts.scheme, parts.netloc, fresh=attempt > 0)
+		try:
+			connection.request(method, path, body, headers)
+			return connection.getresponse()
+		except (httplib.HTTPException, socket.error):
+			connection.close()
+			if attempt > 0:
+				raise
+
+def http_reset(url):
+	""" Drops the connection to the host of url, after a response could not be read completely """
+	parts = urlparse.urlparse(url)
+	pivnet_connection(parts.scheme, parts.netloc, fresh=True)
+
+def pivnet_call(method, url, body=None, headers={}):
+	""" Makes an API call over the keep-alive connection, and returns the response and its (decoded) body """
+	request = pivnet_request(url)
+	request_headers = dict(request.header_items())
+	request_headers['Accept-Encoding'] = 'gzip'
+	request_headers.update(headers)
+	response = http_request(method, url, body, request_headers)
+	try:
+		data = response.read()
+	except (httplib.HTTPException, socket.error):
+		http_reset(url)
+		raise
+	if response.getheader('Content-Encoding') == 'gzip':
+		data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+	if response.status >= 400:
+		raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(data))
+	return response, data
+
 def pivnet_get(url):
-	return urllib2.urlopen(pivnet_request(url))
+	cache_name = PIVNET_CACHE + '/' + hashlib.sha1(url).hexdigest() + '.json'
+	cached = config.load_cache(cache_name, None)
+	headers = {}
+	if cached is not None and cached.get("etag"):
+		headers['If-None-Match'] = cached["etag"]
+	if cached is not None and cached.get("last-modified"):
+		headers['If-Modified-Since'] = cached["last-modified"]
+	response, data = pivnet_call('GET', url, headers=headers)
+	if response.status == 304 and cached is not None:
+		return StringIO(cached["body"])
+	etag = response.getheader('ETag')
+	last_modified = response.getheader('Last-Modified')
+	if etag is not None or last_modified is not None:
+		config.save_cache(cache_name, {
+			"url": url,
+			"etag": etag,
+			"last-modified": last_modified,
+			"body": data,
+		})
+	return StringIO(data)
 
 def pivnet_post(url, data):
-	return urllib2.urlopen(pivnet_request(url), data=urllib.urlencode(data))
+	headers = { 'Content-type': 'application/x-www-form-urlencoded' }
+	response, data = pivnet_call('POST', url, urllib.urlencode(data), headers)
+	return StringIO(data)
+
+def pivnet_all_products():
+	url = pivnet_api_url() + '/products'
+	return json.load(pivnet_get(url))["products"]
 
 def pivnet_products(product_pattern = ""):
-	url = 'https://network.pivotal.io/api/v2/products'
-	all_products = json.load(pivnet_get(url))
-	products = [p for p in all_products["products"] if product_pattern == p["name"]]
-	if len(products) == 0:
-		products = [p for p in all_products["products"] if product_pattern in p["name"]]
-	return products
+	refresh_products()
+	return catalog_match('products', 'name', product_pattern)
 
 def pivnet_select_product(product_pattern):
 	products = pivnet_products(product_pattern)
@@ -45,13 +149,13 @@ def pivnet_select_product(product_pattern):
 		sys.exit(1)
 	return products[0]
 
+def pivnet_all_releases(product):
+	url = pivnet_api_url() + '/products/' + str(product["id"]) + '/releases'
+	return json.load(pivnet_get(url))["releases"]
+
 def pivnet_releases(product, release_pattern = ""):
-	url = 'https://network.pivotal.io/api/v2/products/' + str(product["id"]) + '/releases'
-	all_releases = json.load(pivnet_get(url))
-	releases = [r for r in all_releases["releases"] if release_pattern == r["version"]]
-	if len(releases) == 0:
-		releases = [r for r in all_releases["releases"] if release_pattern in r["version"]]
-	return releases
+	refresh_releases(product)
+	return catalog_match('releases', 'version', release_pattern, 'product_id = ?', (product["id"],), 'release_date DESC, id DESC')
 
 def pivnet_select_release(product, release_pattern=None):
 	if release_pattern is None:
@@ -77,17 +181,125 @@ def pivnet_latest_release(product, controlled=False):
 		sys.exit(1)
 	return sorted(releases, key=lambda release: release["release_date"])[-1]
 
+def pivnet_all_files(product, release):
+	url = pivnet_api_url() + '/products/' + str(product["id"]) + '/releases/' + str(release["id"]) + '/product_files'
+	return json.load(pivnet_get(url))["product_files"]
+
 def pivnet_files(product, release, file_pattern = ""):
-	url = 'https://network.pivotal.io/api/v2/products/' + str(product["id"]) + '/releases/' + str(release["id"]) + '/product_files'
-	all_files = json.load(pivnet_get(url))
-	files = [f for f in all_files["product_files"] if file_pattern == os.path.basename(f["aws_object_key"])]
-	if len(files) == 0:
-		files = [f for f in all_files["product_files"] if file_pattern in os.path.basename(f["aws_object_key"])]
-	return files
+	refresh_files(product, release)
+	return catalog_match('product_files', 'basename', file_pattern, 'release_id = ?', (release["id"],))
+
+def pivnet_file(product, release, file_id):
+	refresh_files(product, release)
+	row = catalog().execute('SELECT data FROM product_files WHERE release_id = ? AND id = ?', (release["id"], file_id)).fetchone()
+	return json.loads(row[0]) if row is not None else None
+
+def pivnet_download_href(file):
+	""" Returns the download link of a file, through the caching proxy if one is configured """
+	href = file["_links"]["download"]["href"]
+	proxy_url = config.get('pivotal-network', 'proxy-url', default=None)
+	if proxy_url is None:
+		return href
+	return proxy_url.rstrip('/') + urlparse.urlparse(href).path
 
 def pivnet_accept_eula(product, release):
-	url = 'https://network.pivotal.io/api/v2/products/' + str(product["id"]) + '/releases/' + str(release["id"]) + '/eula_acceptance'
+	db = catalog()
+	if db.execute('SELECT 1 FROM eula_acceptances WHERE release_id = ?', (release["id"],)).fetchone() is not None:
+		return
+	url = pivnet_api_url() + '/products/' + str(product["id"]) + '/releases/' + str(release["id"]) + '/eula_acceptance'
 	acceptance = json.load(pivnet_post(url, {}))
+	with db:
+		db.execute('INSERT OR REPLACE INTO eula_acceptances VALUES (?, ?)', (release["id"], time.time()))
+
+""" Local catalog of products, releases and product files, so that lookups don't need the network
+
+Each listing is refreshed from PivNet once it is older than [pivotal-network] catalog-ttl seconds.
+"""
+
+CATALOG_DB = PIVNET_CACHE + '/catalog.db'
+CATALOG_TTL = 3600
+CATALOG_SCHEMA = [
+	'CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, name TEXT, slug TEXT, data TEXT)',
+	'CREATE INDEX IF NOT EXISTS products_name ON products (name)',
+	'CREATE INDEX IF NOT EXISTS products_slug ON products (slug)',
+	'CREATE TABLE IF NOT EXISTS releases (id INTEGER PRIMARY KEY, product_id INTEGER, version TEXT, release_date TEXT, data TEXT)',
+	'CREATE INDEX IF NOT EXISTS releases_version ON releases (product_id, version)',
+	'CREATE INDEX IF NOT EXISTS releases_date ON releases (product_id, release_date)',
+	'CREATE TABLE IF NOT EXISTS product_files (id INTEGER, release_id INTEGER, basename TEXT, data TEXT, PRIMARY KEY (release_id, id))',
+	'CREATE INDEX IF NOT EXISTS product_files_basename ON product_files (release_id, basename)',
+	'CREATE TABLE IF NOT EXISTS eula_acceptances (release_id INTEGER PRIMARY KEY, accepted REAL)',
+	'CREATE TABLE IF NOT EXISTS refreshes (listing TEXT PRIMARY KEY, refreshed REAL)',
+]
+
+def catalog():
+	""" Returns this thread's connection to the catalog database """
+	db = getattr(CONNECTIONS, "catalog", None)
+	if db is None:
+		db = sqlite3.connect(config.cache_path(CATALOG_DB))
+		with db:
+			for statement in CATALOG_SCHEMA:
+				db.execute(statement)
+		CONNECTIONS.catalog = db
+	return db
+
+def catalog_match(table, column, pattern, where='1', args=(), order='rowid'):
+	""" Returns the items of which column is pattern, or if there are none, those of which column contains pattern """
+	db = catalog()
+	for condition in [ column + ' = ?', 'instr(' + column + ', ?) > 0' ]:
+		query = 'SELECT data FROM ' + table + ' WHERE ' + where + ' AND ' + condition + ' ORDER BY ' + order
+		rows = db.execute(query, args + (pattern,)).fetchall()
+		if len(rows) > 0:
+			break
+	return [ json.loads(row[0]) for row in rows ]
+
+def is_fresh(db, listing):
+	ttl = float(config.get('pivotal-network', 'catalog-ttl', default=None) or CATALOG_TTL)
+	row = db.execute('SELECT refreshed FROM refreshes WHERE listing = ?', (listing,)).fetchone()
+	return row is not None and time.time() - row[0] < ttl
+
+def set_refreshed(db, listing):
+	db.execute('INSERT OR REPLACE INTO refreshes VALUES (?, ?)', (listing, time.time()))
+
+def refresh_products(force=False):
+	db = catalog()
+	if not force and is_fresh(db, 'products'):
+		return
+	products = pivnet_all_products()
+	with db:
+		db.execute('DELETE FROM products')
+		db.executemany('INSERT INTO products VALUES (?, ?, ?, ?)', [ (p["id"], p["name"], p["slug"], json.dumps(p)) for p in products ])
+		set_refreshed(db, 'products')
+
+def refresh_releases(product, force=False):
+	""" Stores the current descriptors of all releases, and drops those that were withdrawn """
+	db = catalog()
+	listing = 'releases:' + str(product["id"])
+	if not force and is_fresh(db, listing):
+		return
+	# PivNet has no listing of the releases since a date, and older releases change as well, so all
+	# releases are stored again (pivnet_get only downloads the listing again when it changed)
+	releases = pivnet_all_releases(product)
+	known = set(row[0] for row in db.execute('SELECT id FROM releases WHERE product_id = ?', (product["id"],)))
+	withdrawn = known - set(r["id"] for r in releases)
+	with db:
+		db.executemany('INSERT OR REPLACE INTO releases VALUES (?, ?, ?, ?, ?)', [
+			(r["id"], product["id"], r["version"], r.get("release_date"), json.dumps(r)) for r in releases
+		])
+		db.executemany('DELETE FROM releases WHERE id = ?', [ (release_id,) for release_id in withdrawn ])
+		set_refreshed(db, listing)
+
+def refresh_files(product, release, force=False):
+	db = catalog()
+	listing = 'files:' + str(release["id"])
+	if not force and is_fresh(db, listing):
+		return
+	files = pivnet_all_files(product, release)
+	with db:
+		db.execute('DELETE FROM product_files WHERE release_id = ?', (release["id"],))
+		db.executemany('INSERT INTO product_files VALUES (?, ?, ?, ?)', [
+			(f["id"], release["id"], os.path.basename(f["aws_object_key"]), json.dumps(f)) for f in files
+		])
+		set_refreshed(db, listing)
 
 def pivnet_open(file):
 	PIVNET_TOKEN = config.get('pivotal-network', 'token')
@@ -104,29 +316,513 @@ def pivnet_open(file):
 		sys.exit(1)
 
 def pivnet_download(product, release, files, progress=False):
+	""" Downloads files a few at a time, largest first, and returns their paths """
 	target_dir = product["slug"]
 	mkdir_p(target_dir)
+	files = sorted(files, key=lambda f: f.get("size") or 0, reverse=True)
+	meter = DownloadMeter(files, download_rate(), progress)
+	pool = tasks.WorkerPool(min(download_workers(), len(files)))
 	downloads = []
 	for f in files:
-		blocksize = 1 * 1024 * 1024
 		target_name = target_dir + "/" + os.path.basename(f["aws_object_key"])
-		source = pivnet_open(f)
-		if progress:
-			sys.stdout.write(target_name + ' ')
-			sys.stdout.flush()
-		with open(target_name, 'w+') as target:
-			data = source.read(blocksize)
-			while len(data) > 0:
-				target.write(data)
-				if progress:
-					sys.stdout.write('.')
-					sys.stdout.flush()
-				data = source.read(blocksize)
-		if progress:
-			sys.stdout.write('\n')
+		pool.submit(fetch_artifact, f, target_name, meter)
 		downloads.append(target_name)
+	errors = pool.join()
+	meter.finish()
+	if len(errors) > 0:
+		raise errors[0]
 	return downloads
 
+""" Shared store of downloaded files, keyed by PivNet file id and checksum, that downloads link to """
+
+ARTIFACT_DIR = 'artifacts'
+ARTIFACT_INDEX = ARTIFACT_DIR + '/index.json'
+ARTIFACT_STORE_SIZE = 50
+
+def artifact_key(file):
+	checksum = file.get("sha256") or file.get("md5") or "unknown"
+	return str(file["id"]) + '-' + checksum
+
+def artifact_path(key, name):
+	return config.cache_path(ARTIFACT_DIR, key, name)
+
+def artifact_store_size():
+	""" Returns the disk budget of the artifact store in bytes """
+	return float(config.get('cache', 'artifacts-size', default=None) or ARTIFACT_STORE_SIZE) * 1e9
+
+def fetch_artifact(file, target_name, meter):
+	""" Links target_name to the stored copy of a file """
+	link = lambda path: link_artifact(path, target_name)
+	linked, received, elapsed = store_artifact(file, meter, link)
+	meter.file_done(target_name, received, elapsed)
+
+def store_artifact(file, meter=None, use=lambda path: path):
+	""" Downloads a file into the store unless it is there, and returns use(path) with the bytes and seconds that took
+
+	The artifact is locked while use is called, so that it can't be evicted before use has linked
+	or opened it. The bytes received are None when the file was already in the store.
+	"""
+	meter = meter if meter is not None else DownloadMeter([ file ])
+	key = artifact_key(file)
+	path = artifact_path(key, os.path.basename(file["aws_object_key"]))
+	with artifact_lock(key):
+		if os.path.exists(path):
+			meter.expect(file, os.path.getsize(path))
+			meter.add(os.path.getsize(path), resumed=True)
+			received, elapsed = None, 0
+		else:
+			# The download is only published to the store (by renaming it) once it is complete and verified
+			download = SegmentedDownload(file, path, download_connections(), meter)
+			received, elapsed = download.run()
+		use_artifact(file, path)
+		result = use(path)
+	evict_artifacts(artifact_store_size(), keep=[ key ])
+	return result, received, elapsed
+
+def artifact_lock(key, blocking=True):
+	return config.cache_lock(ARTIFACT_DIR + '/' + key, blocking)
+
+def link_artifact(path, target_name):
+	if os.path.exists(target_name):
+		if os.path.samefile(path, target_name):
+			return
+		os.remove(target_name)
+	try:
+		os.link(path, target_name)
+	except OSError as error:
+		if error.errno not in [ errno.EXDEV, errno.EPERM ]:
+			raise
+		# The store is on another file system (or doesn't allow links), so a copy has to do
+		shutil.copyfile(path, target_name)
+
+def update_artifacts(update):
+	""" Applies update to the artifact index under a lock, and returns what update returned """
+	with config.cache_lock(ARTIFACT_INDEX):
+		index = config.load_cache(ARTIFACT_INDEX, {})
+		result = update(index)
+		config.save_cache(ARTIFACT_INDEX, index)
+	return result
+
+def use_artifact(file, path):
+	def update(index):
+		index[artifact_key(file)] = {
+			"name": os.path.basename(path),
+			"size": os.path.getsize(path),
+			"sha256": file.get("sha256"),
+			"md5": file.get("md5"),
+			"used": time.time(),
+		}
+	update_artifacts(update)
+
+def evict_artifacts(size, keep=[]):
+	""" Removes the least recently used artifacts until the store fits in size bytes, and returns their keys """
+	def update(index):
+		total = sum(artifact["size"] for artifact in index.values())
+		evicted = []
+		for key in sorted(index.keys(), key=lambda key: index[key]["used"]):
+			if total <= size:
+				break
+			if key in keep:
+				continue
+			artifact_size = index[key]["size"]
+			if remove_artifact(index, key):
+				total -= artifact_size
+				evicted.append(key)
+		return evicted
+	return update_artifacts(update)
+
+def remove_artifact(index, key):
+	""" Removes an artifact from the store, unless it is being stored or used right now, and returns whether it did
+
+	The artifact lock is not waited for, as that is taken before the index lock this runs under.
+	"""
+	with artifact_lock(key, blocking=False) as locked:
+		if not locked:
+			return False
+		# Working directories keep their hard links to the file, so only the store's copy goes
+		shutil.rmtree(os.path.join(config.CACHE_DIR, ARTIFACT_DIR, key), ignore_errors=True)
+		del index[key]
+		return True
+
+def verify_artifact(key, artifact):
+	""" Returns whether a stored artifact is present and matches its checksum """
+	path = artifact_path(key, artifact["name"])
+	algorithm = "sha256" if artifact.get("sha256") else "md5" if artifact.get("md5") else None
+	if not os.path.exists(path):
+		return False
+	if algorithm is None:
+		return True
+	checksum = getattr(hashlib, algorithm)()
+	with open(path, 'rb') as artifact_file:
+		for data in iter(lambda: artifact_file.read(DOWNLOAD_BLOCK_SIZE), ''):
+			checksum.update(data)
+	return checksum.hexdigest() == artifact[algorithm]
+
+""" Segmented downloads, fetching byte ranges of a file over several connections at once """
+
+DOWNLOAD_WORKERS = 3
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_SEGMENT_SIZE = 32 * 1024 * 1024
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+
+def download_workers():
+	return int(config.get('pivotal-network', 'download-workers', default=None) or DOWNLOAD_WORKERS)
+
+def download_rate():
+	""" Returns the bandwidth cap for all downloads together in bytes per second, or None """
+	rate = float(config.get('pivotal-network', 'download-rate', default=None) or 0)
+	return rate * 1e6 if rate > 0 else None
+
+def download_connections():
+	return int(config.get('pivotal-network', 'download-connections', default=None) or DOWNLOAD_CONNECTIONS)
+
+class DownloadMeter(object):
+	""" Shows the combined progress of concurrent downloads on one status line, and caps their bandwidth
+
+	The cap is a token bucket shared by all downloads, refilled at the capped rate and holding
+	at most one second worth of data. A download that takes more than the bucket holds waits
+	until the bucket has been refilled for what it took.
+	"""
+
+	def __init__(self, files, rate=None, show=False):
+		self.sizes = dict((f["id"], f.get("size") or 0) for f in files)
+		self.files = len(files)
+		self.done_files = 0
+		self.received = 0
+		self.resumed = 0
+		self.rate = rate
+		self.tokens = rate
+		self.filled = time.time()
+		self.show = show
+		self.shown = 0
+		self.starttime = time.time()
+		self.lock = threading.Lock()
+
+	def expect(self, file, size):
+		with self.lock:
+			self.sizes[file["id"]] = size
+
+	def throttle(self, size):
+		if self.rate is None:
+			return
+		with self.lock:
+			now = time.time()
+			self.tokens = min(self.rate, self.tokens + (now - self.filled) * self.rate) - size
+			self.filled = now
+			delay = -self.tokens / self.rate
+		if delay > 0:
+			time.sleep(delay)
+
+	def add(self, size, resumed=False):
+		with self.lock:
+			if resumed:
+				self.resumed += size
+			else:
+				self.received += size
+			if self.show and time.time() - self.shown >= 0.5:
+				self.shown = time.time()
+				self.write_status()
+
+	def file_done(self, target, received, elapsed):
+		""" Reports a finished file, of which received is None when it came from the artifact store """
+		with self.lock:
+			self.done_files += 1
+			if self.show and received is None:
+				self.write_line("%s (from cache)" % target)
+			elif self.show:
+				self.write_line("%s %.1f MB in %.1f seconds (%.1f MB/s)" % (target, received / 1e6, elapsed, received / 1e6 / max(elapsed, 0.001)))
+				self.write_status()
+
+	def finish(self):
+		if self.show:
+			elapsed = time.time() - self.starttime
+			with self.lock:
+				self.write_line("%d of %d files, %.1f MB in %.1f seconds (%.1f MB/s)" % (self.done_files, self.files, self.received / 1e6, elapsed, self.received / 1e6 / max(elapsed, 0.001)))
+
+	def write_status(self):
+		elapsed = max(time.time() - self.starttime, 0.001)
+		rate = self.received / elapsed
+		remaining = max(0, sum(self.sizes.values()) - self.received - self.resumed)
+		eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate)) if rate > 0 else '--:--:--'
+		status = "%d of %d files, %.1f of %.1f MB, %.1f MB/s, ETA %s" % (self.done_files, self.files, (self.received + self.resumed) / 1e6, sum(self.sizes.values()) / 1e6, rate / 1e6, eta)
+		with tasks.LOG_LOCK:
+			sys.stdout.write(status.ljust(79) + '\r')
+			sys.stdout.flush()
+
+	def write_line(self, line):
+		with tasks.LOG_LOCK:
+			sys.stdout.write(line.ljust(79) + '\n')
+			sys.stdout.flush()
+
+def pivnet_download_url(file):
+	""" Returns the short-lived storage URL that the download link of a file redirects to """
+	href = file["_links"]["download"]["href"]
+	headers = { 'Content-type': 'application/x-www-form-urlencoded' }
+	response, data = pivnet_call('POST', href, urllib.urlencode({}), headers)
+	location = response.getheader('Location')
+	if response.status not in [ 301, 302, 303, 307 ] or location is None:
+		raise urllib2.HTTPError(href, response.status, 'Download link did not redirect', response.msg, StringIO(data))
+	return urlparse.urljoin(href, location)
+
+def storage_get(url, start, end):
+	""" Starts a GET of a byte range from storage (which must not see the PivNet token) """
+	response = http_request('GET', url, headers={ 'Range': 'bytes=%d-%d' % (start, end) })
+	if response.status >= 400:
+		data = response.read()
+		raise urllib2.HTTPError(url, response.status, response.reason, response.msg, StringIO(data))
+	return response
+
+class SegmentedDownload(object):
+	""" Downloads a file in byte ranges over several connections into a preallocated file
+
+	Completed segments are recorded in a manifest next to the partial file, so an interrupted
+	download resumes where it stopped. The data is hashed in file order while it is written:
+	blocks that extend the hashed part are hashed right away, and segments that complete ahead
+	of it are read back (usually from the page cache) once the hashed part reaches them.
+	"""
+
+	def __init__(self, file, target, connections=DOWNLOAD_CONNECTIONS, meter=None):
+		self.file = file
+		self.target = target
+		self.part = target + '.part'
+		self.manifest_path = target + '.part.json'
+		self.connections = connections
+		self.meter = meter if meter is not None else DownloadMeter([ file ])
+		self.checksums = dict((a, getattr(hashlib, a)()) for a in [ "sha256", "md5" ] if file.get(a))
+		self.lock = threading.Lock()
+		self.hashed = 0
+		self.received = 0
+
+	def run(self):
+		""" Downloads the file and returns the number of bytes received and the seconds that took """
+		starttime = time.time()
+		self.url = pivnet_download_url(self.file)
+		response = storage_get(self.url, 0, 0)
+		if response.status == 206:
+			response.read()
+			self.start(int(response.getheader('Content-Range').split('/')[-1]), DOWNLOAD_SEGMENT_SIZE)
+			segments = [ index for index in range(self.segments) if index not in self.manifest["done"] ]
+			pool = tasks.WorkerPool(min(self.connections, len(segments)))
+			for index in segments:
+				pool.submit(self.fetch_segment, index)
+			errors = pool.join()
+			if len(errors) > 0:
+				raise errors[0]
+		else:
+			# Storage that does not support ranges sends the whole file as one segment
+			size = int(response.getheader('Content-Length'))
+			self.start(size, size, resume=False)
+			try:
+				self.write(response, 0, size)
+			except (httplib.HTTPException, socket.error):
+				http_reset(self.url)
+				raise
+			self.complete(0)
+		self.verify()
+		os.rename(self.part, self.target)
+		os.remove(self.manifest_path)
+		return self.received, time.time() - starttime
+
+	def start(self, size, segment_size, resume=True):
+		self.size = size
+		self.meter.expect(self.file, size)
+		self.segment_size = max(1, segment_size)
+		self.segments = max(1, (size + self.segment_size - 1) // self.segment_size)
+		manifest = {
+			"id": self.file["id"],
+			"size": size,
+			"segment-size": self.segment_size,
+			"checksum": self.file.get("sha256") or self.file.get("md5"),
+		}
+		try:
+			with open(self.manifest_path, 'rb') as manifest_file:
+				saved = json.load(manifest_file)
+			if resume and os.path.getsize(self.part) == size and all(saved.get(k) == v for k, v in manifest.items()):
+				self.manifest = saved
+				self.manifest["done"] = set(saved["done"])
+				self.meter.add(sum(min(size, (index + 1) * self.segment_size) - index * self.segment_size for index in self.manifest["done"]), resumed=True)
+				with self.lock:
+					self.advance()
+				return
+		except (IOError, OSError, ValueError):
+			pass
+		with open(self.part, 'wb') as part:
+			part.truncate(size)
+		self.manifest = manifest
+		self.manifest["done"] = set()
+		self.save_manifest()
+
+	def save_manifest(self):
+		manifest = dict(self.manifest)
+		manifest["done"] = sorted(manifest["done"])
+		with open(self.manifest_path + '.tmp', 'wb') as manifest_file:
+			json.dump(manifest, manifest_file)
+		os.rename(self.manifest_path + '.tmp', self.manifest_path)
+
+	def fetch_segment(self, index):
+		position = index * self.segment_size
+		end = min(self.size, position + self.segment_size)
+		for attempt in range(DOWNLOAD_RETRIES):
+			url = self.url
+			try:
+				response = storage_get(url, position, end - 1)
+				if response.status != 206:
+					raise httplib.HTTPException('storage did not return the range of segment ' + str(index))
+				position = self.write(response, position, end)
+				break
+			except urllib2.HTTPError as error:
+				if attempt == DOWNLOAD_RETRIES - 1:
+					raise
+				if error.code == 403:
+					# The storage URL expired, so ask PivNet for a new one
+					with self.lock:
+						if self.url == url:
+							self.url = pivnet_download_url(self.file)
+			except (httplib.HTTPException, socket.error):
+				http_reset(url)
+				if attempt == DOWNLOAD_RETRIES - 1:
+					raise
+		self.complete(index)
+
+	def write(self, response, position, end):
+		""" Writes a response to the file, starting at position, and returns the position reached """
+		with open(self.part, 'r+b', 0) as part:
+			part.seek(position)
+			while position < end:
+				data = response.read(min(DOWNLOAD_BLOCK_SIZE, end - position))
+				if len(data) == 0:
+					raise httplib.IncompleteRead('', end - position)
+				self.meter.throttle(len(data))
+				part.write(data)
+				self.meter.add(len(data))
+				with self.lock:
+					if position == self.hashed:
+						self.hash(data)
+					self.received += len(data)
+				position += len(data)
+		return position
+
+	def complete(self, index):
+		with self.lock:
+			self.manifest["done"].add(index)
+			self.save_manifest()
+			self.advance()
+
+	def hash(self, data):
+		for checksum in self.checksums.values():
+			checksum.update(data)
+		self.hashed += len(data)
+
+	def advance(self):
+		""" Hashes completed segments that the hashed part of the file has reached """
+		with open(self.part, 'rb') as part:
+			while self.hashed < self.size and self.hashed // self.segment_size in self.manifest["done"]:
+				end = min(self.size, (self.hashed // self.segment_size + 1) * self.segment_size)
+				part.seek(self.hashed)
+				while self.hashed < end:
+					self.hash(part.read(min(DOWNLOAD_BLOCK_SIZE, end - self.hashed)))
+
+	def verify(self):
+		for algorithm, checksum in self.checksums.items():
+			if checksum.hexdigest() != self.file[algorithm]:
+				os.remove(self.part)
+				os.remove(self.manifest_path)
+				print "Checksum mismatch for", self.target
+				sys.exit(1)
+
+""" Caching proxy, that serves download links from the artifact store and fills the store from PivNet once """
+
+PROXY_PORT = 8080
+PROXY_PATH = re.compile(r'/products/(\d+)/releases/(\d+)/product_files/(\d+)/download$')
+
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	""" Serves a download link, with the same authorization as PivNet, and with byte range support """
+
+	protocol_version = 'HTTP/1.1'
+
+	def do_GET(self):
+		self.serve(True)
+
+	def do_HEAD(self):
+		self.serve(False)
+
+	def do_POST(self):
+		# PivNet download links are POSTed to (with an empty body)
+		self.rfile.read(int(self.headers.get('Content-Length') or 0))
+		self.serve(True)
+
+	def serve(self, send_body):
+		match = PROXY_PATH.search(urlparse.urlparse(self.path).path)
+		if match is None:
+			return self.send_error(404)
+		if self.headers.get('Authorization') != 'Token ' + config.get('pivotal-network', 'token'):
+			return self.send_error(401)
+		product_id, release_id, file_id = [ int(group) for group in match.groups() ]
+		try:
+			file = pivnet_file({ "id": product_id }, { "id": release_id }, file_id)
+			if file is None:
+				return self.send_error(404)
+			# The artifact is opened before it can be evicted, and an open file can still be read once it is
+			artifact_file, received, elapsed = store_artifact(file, use=lambda path: open(path, 'rb'))
+		except urllib2.HTTPError as error:
+			return self.send_error(error.code, error.reason)
+		except (httplib.HTTPException, socket.error, SystemExit) as error:
+			return self.send_error(502, str(error))
+		with artifact_file as artifact:
+			size = os.fstat(artifact.fileno()).st_size
+			byte_range = parse_range(self.headers.get('Range'), size)
+			if byte_range is False:
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */%d' % size)
+				self.send_header('Content-Length', '0')
+				self.end_headers()
+				return
+			first, last = byte_range if byte_range is not None else (0, size - 1)
+			self.send_response(206 if byte_range is not None else 200)
+			if byte_range is not None:
+				self.send_header('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+			self.send_header('Accept-Ranges', 'bytes')
+			self.send_header('Content-Type', 'application/octet-stream')
+			self.send_header('Content-Length', str(last - first + 1))
+			self.end_headers()
+			if not send_body:
+				return
+			artifact.seek(first)
+			remaining = last - first + 1
+			while remaining > 0:
+				data = artifact.read(min(DOWNLOAD_BLOCK_SIZE, remaining))
+				if len(data) == 0:
+					break
+				self.wfile.write(data)
+				remaining -= len(data)
+
+	def log_message(self, format, *args):
+		tasks.log(self.client_address[0], format % args)
+
+def parse_range(header, size):
+	""" Returns the first and last byte of a single byte range, None for the whole file, or False if the range is unsatisfiable """
+	match = re.match(r'^bytes=(\d*)-(\d*)$', header or '')
+	if match is None or match.groups() == ('', ''):
+		return None
+	first, last = match.groups()
+	if first == '':
+		first, last = max(0, size - int(last)), size - 1
+	else:
+		first, last = int(first), min(size - 1, int(last)) if last != '' else size - 1
+	if first < 0 or first > last:
+		return False
+	return first, last
+
+def pivnet_serve(port=PROXY_PORT):
+	server = ProxyServer(('', port), ProxyHandler)
+	print "Serving PivNet downloads on port", port
+	server.serve_forever()
+
 def mkdir_p(dir):
 	try:
 		os.makedirs(dir)
@@ -167,6 +863,17 @@ def accept_eula(argv):
 	release = pivnet_select_release(product, release_pattern)
 	pivnet_accept_eula(product, release)
 
+def refresh(argv):
+	product_pattern = argv[1] if len(argv) > 1 else None
+	refresh_products(force=True)
+	if product_pattern is not None:
+		product = pivnet_select_product(product_pattern)
+		refresh_releases(product, force=True)
+		# File listings of the releases are refreshed when they are next used
+		db = catalog()
+		with db:
+			db.executemany('DELETE FROM refreshes WHERE listing = ?', [ ('files:' + str(r["id"]),) for r in pivnet_releases(product) ])
+
 def download(argv):
 	cli.exit_with_usage(argv) if len(argv) < 3 else None
 	product_pattern = argv[1]
@@ -184,12 +891,41 @@ def download(argv):
 			print error.reason, '(', error.code, ')'
 		sys.exit(1)
 
+def serve(argv):
+	port = int(argv[1]) if len(argv) > 1 else PROXY_PORT
+	pivnet_serve(port)
+
+def manage_cache(argv):
+	cli.exit_with_usage(argv) if len(argv) < 2 or argv[1] not in [ "list", "verify", "prune" ] else None
+	action = argv[1]
+	index = config.load_cache(ARTIFACT_INDEX, {})
+	if action == "list":
+		keys = sorted(index.keys(), key=lambda key: index[key]["used"], reverse=True)
+		for key in keys:
+			artifact = index[key]
+			print "%10.1f MB  %s  %s  %s" % (artifact["size"] / 1e6, time.strftime('%Y-%m-%d %H:%M', time.localtime(artifact["used"])), key, artifact["name"])
+		print "%10.1f MB in %d files, of %.1f MB allowed" % (sum(a["size"] for a in index.values()) / 1e6, len(index), artifact_store_size() / 1e6)
+	elif action == "verify":
+		bad = [ key for key in sorted(index.keys()) if not verify_artifact(key, index[key]) ]
+		for key in bad:
+			print "removing", key, index[key]["name"], "(missing or corrupt)"
+		update_artifacts(lambda index: [ remove_artifact(index, key) for key in bad if key in index ])
+		print len(index) - len(bad), "of", len(index), "artifacts verified"
+		return 1 if len(bad) > 0 else 0
+	elif action == "prune":
+		size = float(argv[2]) * 1e9 if len(argv) > 2 else artifact_store_size()
+		evicted = evict_artifacts(size)
+		print "removed", len(evicted), "artifacts"
+
 commands = {
 	"products":    { "func": list_products, "usage": "products [<product-name>]" },
 	"releases":    { "func": list_releases, "usage": "releases <product-name> [<release-name>]" },
 	"accept-eula": { "func": accept_eula,   "usage": "accept-eula <product-name> <release-name>" },
 	"files":       { "func": list_files,    "usage": "files <product-name> <release-name> [<file-name>]" },
 	"download":    { "func": download,      "usage": "download <product-name> <release-name> [<file-name>]" },
+	"refresh":     { "func": refresh,       "usage": "refresh [<product-name>]" },
+	"cache":       { "func": manage_cache,  "usage": "cache list|verify|prune [<size-in-GB>]" },
+	"serve":       { "func": serve,         "usage": "serve [<port>]" },
 }
 
 if __name__ == '__main__':
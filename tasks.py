@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import threading
+import Queue
+import collections
+
+""" Bounded worker pools and dependency graph execution """
+
+LOG_LOCK = threading.Lock()
+
+def log(*words):
+	""" Thread-safe equivalent of a print statement """
+	line = ' '.join([str(word) for word in words]) + '\n'
+	with LOG_LOCK:
+		sys.stdout.write(line)
+		sys.stdout.flush()
+
+class RetryLater(Exception):
+	""" Raised by a task that cannot complete yet and should be retried after a backoff """
+
+class TaskGraph(object):
+	""" Runs tasks on a bounded pool of workers, each task only after all its dependencies completed
+
+	Tasks that raise RetryLater are rescheduled with exponential backoff. Tasks that fail
+	in any other way (or that run out of retries) cause all tasks depending on them to be
+	skipped, while independent branches of the graph run to completion.
+
+	A task that only starts an asynchronous operation can return a function that tells
+	whether the operation has finished. The task then stays pending, without holding on
+	to a worker, and a poller calls that function every poll_interval seconds until it
+	returns True. Only then do the dependents of the task start.
+	"""
+
+	def __init__(self, workers=8, retries=10, backoff=5, max_backoff=60, poll_interval=15):
+		self.workers = workers
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.poll_interval = poll_interval
+		self.tasks = collections.OrderedDict()
+
+	def add(self, name, func, depends=[]):
+		""" Adds a task, ignoring a duplicate name. Dependencies on unknown tasks are ignored """
+		if name not in self.tasks:
+			self.tasks[name] = {
+				"name": name,
+				"func": func,
+				"depends": list(depends),
+				"attempts": 0,
+			}
+		return name
+
+	def __contains__(self, name):
+		return name in self.tasks
+
+	def run(self):
+		""" Runs all tasks and returns the names of those that failed or were skipped """
+		waiting = dict((name, set(d for d in task["depends"] if d in self.tasks)) for name, task in self.tasks.items())
+		dependents = collections.defaultdict(list)
+		for name, depends in waiting.items():
+			for dependency in depends:
+				dependents[dependency].append(name)
+		work = Queue.Queue()
+		results = Queue.Queue()
+		workers = []
+		for _ in range(max(1, min(self.workers, len(self.tasks)))):
+			worker = threading.Thread(target=run_worker, args=(work, results))
+			worker.daemon = True
+			worker.start()
+			workers.append(worker)
+		poller = Poller(self.poll_interval, results)
+		poller.start()
+		ready = [ name for name in self.tasks if len(waiting[name]) == 0 ]
+		retries = []
+		running = 0
+		failed = []
+		remaining = len(self.tasks)
+		while remaining > 0:
+			now = time.time()
+			ready += [ name for due, name in retries if due <= now ]
+			retries = [ (due, name) for due, name in retries if due > now ]
+			for name in ready:
+				self.tasks[name]["attempts"] += 1
+				work.put(self.tasks[name])
+				running += 1
+			ready = []
+			if running == 0 and len(retries) == 0:
+				break
+			timeout = max(0.1, min([ due for due, name in retries ]) - now) if len(retries) > 0 else None
+			try:
+				name, outcome = results.get(timeout=timeout) if timeout is not None else results.get()
+			except Queue.Empty:
+				continue
+			running -= 1
+			task = self.tasks[name]
+			if isinstance(outcome, Pending):
+				poller.add(name, outcome.is_done)
+				running += 1
+				continue
+			if isinstance(outcome, RetryLater) and task["attempts"] <= self.retries:
+				delay = min(self.max_backoff, self.backoff * 2 ** (task["attempts"] - 1))
+				log("retrying", name, "in", delay, "seconds:", outcome)
+				retries.append((time.time() + delay, name))
+				continue
+			remaining -= 1
+			if outcome is None:
+				for dependent in dependents[name]:
+					waiting[dependent].discard(name)
+					if len(waiting[dependent]) == 0:
+						ready.append(dependent)
+			else:
+				log("failed", name + ":", outcome)
+				for skipped in self.dependents_of(name, dependents):
+					if skipped not in failed:
+						log("skipped", skipped)
+						failed.append(skipped)
+						remaining -= 1
+				failed.append(name)
+		for worker in workers:
+			work.put(None)
+		for worker in workers:
+			worker.join()
+		poller.stop()
+		return failed
+
+	def dependents_of(self, name, dependents):
+		found = []
+		pending = list(dependents[name])
+		while len(pending) > 0:
+			dependent = pending.pop(0)
+			if dependent not in found:
+				found.append(dependent)
+				pending += dependents[dependent]
+		return found
+
+class Pending(object):
+	def __init__(self, is_done):
+		self.is_done = is_done
+
+class Poller(threading.Thread):
+	""" Polls pending operations and reports them to the graph once they are done """
+
+	def __init__(self, interval, results):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.interval = interval
+		self.results = results
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+
+	def add(self, name, is_done):
+		with self.lock:
+			self.pending[name] = is_done
+
+	def stop(self):
+		self.stopped.set()
+		self.join()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			with self.lock:
+				pending = self.pending.items()
+			for name, is_done in pending:
+				try:
+					if not is_done():
+						continue
+					outcome = None
+				except BaseException as error:
+					outcome = error if str(error) else repr(error)
+				with self.lock:
+					del self.pending[name]
+				self.results.put((name, outcome))
+
+def run_worker(work, results):
+	while True:
+		task = work.get()
+		if task is None:
+			return
+		try:
+			result = task["func"]()
+			results.put((task["name"], Pending(result) if callable(result) else None))
+		except RetryLater as retry:
+			results.put((task["name"], retry))
+		except BaseException as error:
+			results.put((task["name"], error if str(error) else repr(error)))
+
+class WorkerPool(object):
+	""" Runs submitted functions on a bounded number of threads
+
+	With a backlog, submit blocks while that many functions are waiting for a worker,
+	which keeps a fast producer from running ahead of its consumers.
+	"""
+
+	def __init__(self, workers, backlog=0):
+		self.work = Queue.Queue(maxsize=backlog)
+		self.errors = []
+		self.lock = threading.Lock()
+		self.threads = []
+		for _ in range(max(1, workers)):
+			thread = threading.Thread(target=self.run)
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def submit(self, func, *args):
+		self.work.put((func, args))
+
+	def run(self):
+		while True:
+			item = self.work.get()
+			if item is None:
+				return
+			func, args = item
+			try:
+				func(*args)
+			except BaseException as error:
+				with self.lock:
+					self.errors.append(error)
+
+	def join(self):
+		""" Waits for all submitted functions to finish and returns the errors they raised """
+		for thread in self.threads:
+			self.work.put(None)
+		for thread in self.threads:
+			thread.join()
+		return self.errors
+
+def parallel_map(func, items, workers=8):
+	""" Like map, but calls func on a bounded number of threads. Re-raises the first error """
+	items = list(items)
+	results = [ None ] * len(items)
+	def call(index):
+		results[index] = func(items[index])
+	pool = WorkerPool(min(workers, len(items)))
+	for index in range(len(items)):
+		pool.submit(call, index)
+	errors = pool.join()
+	if len(errors) > 0:
+		raise errors[0]
+	return results